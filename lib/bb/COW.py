@@ -18,6 +18,11 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
+# The dictionaries are persistent hash array mapped tries (HAMT): a copy
+# shares the whole trie with its parent and a change only rebuilds the
+# nodes on the path to the changed key, so lookups cost the same however
+# many copies deep a dictionary is and taking a copy is O(1).
+#
 #Please Note:
 # Be careful when using mutable types (ie Dict and Lists) - operations involving these are SLOW.
 # Assign a file to __warn__ to get warnings about slow operations.
@@ -39,166 +44,317 @@ ImmutableTypes = (
 )
 
 MUTABLE = "__mutable__"
-
-class COWMeta(type):
+_immutable = frozenset((str, int, tuple, bool, types.NoneType))
+_notfound = object()
+
+# Each trie level consumes 5 bits of the (32 bit) key hash, keys whose
+# hashes are equal are kept together in a collision node
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_MAXSHIFT = 30
+
+def _hash(key):
+    return hash(key) & 0xffffffff
+
+def _index(bitmap, bit):
+    return bin(bitmap & (bit - 1)).count("1")
+
+class _Node(object):
+    """
+    A trie node. array holds a (key, value) pair for every bit set in
+    bitmap; subtries are stored as (_Node, node) pairs.
+    """
+    __slots__ = ("bitmap", "array")
+
+    def __init__(self, bitmap, array):
+        self.bitmap = bitmap
+        self.array = array
+
+class _Collision(object):
+    __slots__ = ("hash", "array")
+
+    def __init__(self, h, array):
+        self.hash = h
+        self.array = array
+
+def _lookup(node, h, key, _Node=_Node, _Collision=_Collision, bin=bin):
+    while node is not None:
+        if type(node) is _Collision:
+            array = node.array
+            for i in xrange(0, len(array), 2):
+                if array[i] == key:
+                    return array[i + 1]
+            break
+        bitmap = node.bitmap
+        bit = 1 << (h & _MASK)
+        if not bitmap & bit:
+            break
+        i = bin(bitmap & (bit - 1)).count("1") << 1
+        array = node.array
+        k = array[i]
+        if k is _Node:
+            node = array[i + 1]
+            h >>= _BITS
+            continue
+        if k is key or k == key:
+            return array[i + 1]
+        break
+    raise KeyError(key)
+
+def _pair(shift, h1, k1, v1, h2, k2, v2):
+    """Return a node holding two keys which share a path down to shift"""
+    if shift > _MAXSHIFT:
+        return _Collision(h1, (k1, v1, k2, v2))
+    i1 = (h1 >> shift) & _MASK
+    i2 = (h2 >> shift) & _MASK
+    if i1 == i2:
+        return _Node(1 << i1, (_Node, _pair(shift + _BITS, h1, k1, v1, h2, k2, v2)))
+    if i1 < i2:
+        return _Node((1 << i1) | (1 << i2), (k1, v1, k2, v2))
+    return _Node((1 << i1) | (1 << i2), (k2, v2, k1, v1))
+
+def _assoc(node, shift, h, key, value):
+    """Return (node with key set to value, whether key was added)"""
+    if node is None:
+        return _Node(1 << (h & _MASK), (key, value)), True
+    if type(node) is _Collision:
+        array = node.array
+        for i in xrange(0, len(array), 2):
+            if array[i] == key:
+                if array[i + 1] is value:
+                    return node, False
+                return _Collision(node.hash, array[:i + 1] + (value,) + array[i + 2:]), False
+        return _Collision(node.hash, array + (key, value)), True
+
+    bit = 1 << ((h >> shift) & _MASK)
+    i = 2 * _index(node.bitmap, bit)
+    array = node.array
+    if not node.bitmap & bit:
+        return _Node(node.bitmap | bit, array[:i] + (key, value) + array[i:]), True
+
+    k = array[i]
+    v = array[i + 1]
+    if k is _Node:
+        sub, added = _assoc(v, shift + _BITS, h, key, value)
+        if sub is v:
+            return node, False
+        entry = (_Node, sub)
+    elif k is key or k == key:
+        if v is value:
+            return node, False
+        entry = (k, value)
+        added = False
+    else:
+        entry = (_Node, _pair(shift + _BITS, _hash(k), k, v, h, key, value))
+        added = True
+    return _Node(node.bitmap, array[:i] + entry + array[i + 2:]), added
+
+def _without(node, shift, h, key):
+    """Return node with key removed, None when that leaves it empty"""
+    if node is None:
+        raise KeyError(key)
+    if type(node) is _Collision:
+        array = node.array
+        for i in xrange(0, len(array), 2):
+            if array[i] == key:
+                # A single key left is pulled up by the parent node
+                return _Collision(node.hash, array[:i] + array[i + 2:])
+        raise KeyError(key)
+
+    bit = 1 << ((h >> shift) & _MASK)
+    if not node.bitmap & bit:
+        raise KeyError(key)
+    i = 2 * _index(node.bitmap, bit)
+    array = node.array
+    k = array[i]
+    if k is _Node:
+        sub = _without(array[i + 1], shift + _BITS, h, key)
+        if sub is not None:
+            if len(sub.array) == 2 and sub.array[0] is not _Node:
+                # Pull a single remaining key up into this node
+                entry = sub.array
+            else:
+                entry = (_Node, sub)
+            return _Node(node.bitmap, array[:i] + entry + array[i + 2:])
+    elif not (k is key or k == key):
+        raise KeyError(key)
+    if len(array) == 2:
+        return None
+    return _Node(node.bitmap & ~bit, array[:i] + array[i + 2:])
+
+def _iterate(node):
+    if node is None:
+        return
+    array = node.array
+    for i in xrange(0, len(array), 2):
+        if array[i] is _Node:
+            for item in _iterate(array[i + 1]):
+                yield item
+        else:
+            yield array[i], array[i + 1]
+
+class COWMeta(object):
     pass
 
 class COWDictMeta(COWMeta):
     __warn__ = False
     __hasmutable__ = False
-    __marker__ = tuple()
 
-    def __str__(cls):
-        # FIXME: I have magic numbers!
-        return "<COWDict Level: %i Current Keys: %i>" % (cls.__count__, len(cls.__dict__) - 3)
+    def __init__(self):
+        self.__count__ = 0
+        self.__root = None
+        self.__len = 0
+        # The trie this level was copied from, for __revertitem__
+        self.__parent = None
+        # Mutable values this level has its own copy of
+        self.__owned = set()
+        # Values found in the trie by this level, to save walking it
+        # again for repeated lookups
+        self.__found = {}
+
+    def __str__(self):
+        return "<COWDict Level: %i Current Keys: %i>" % (self.__count__, self.__len)
     __repr__ = __str__
 
-    def cow(cls):
-        class C(cls):
-            __count__ = cls.__count__ + 1
-        return C
+    def cow(self):
+        new = self.__class__()
+        new.__count__ = self.__count__ + 1
+        new.__root = new.__parent = self.__root
+        new.__len = self.__len
+        new.__hasmutable__ = self.__hasmutable__
+        # Both sides now share the mutable values, each has to copy
+        # them before changing them
+        self.__owned = set()
+        return new
     copy = cow
     __call__ = cow
 
-    def __setitem__(cls, key, value):
+    def __len__(self):
+        return self.__len
+
+    def __setitem__(self, key, value):
         if not isinstance(value, ImmutableTypes):
             if not isinstance(value, COWMeta):
-                cls.__hasmutable__ = True
-            key += MUTABLE
-        setattr(cls, key, value)
-
-    def __getmutable__(cls, key, readonly=False):
-        nkey = key + MUTABLE
-        try:
-            return cls.__dict__[nkey]
-        except KeyError:
-            pass
-
-        value = getattr(cls, nkey)
-        if readonly:
+                self.__hasmutable__ = True
+            self.__owned.add(key)
+        self.__root, added = _assoc(self.__root, 0, _hash(key), key, value)
+        self.__found[key] = value
+        if added:
+            self.__len += 1
+
+    def __getmutable__(self, key, value):
+        if key in self.__owned:
             return value
 
-        if not cls.__warn__ is False and not isinstance(value, COWMeta):
-            print("Warning: Doing a copy because %s is a mutable type." % key, file=cls.__warn__)
+        if not self.__warn__ is False and not isinstance(value, COWMeta):
+            print("Warning: Doing a copy because %s is a mutable type." % key, file=self.__warn__)
         try:
             value = value.copy()
         except AttributeError as e:
             value = copy.copy(value)
-        setattr(cls, nkey, value)
+        self.__root = _assoc(self.__root, 0, _hash(key), key, value)[0]
+        self.__found[key] = value
+        self.__owned.add(key)
         return value
 
     __getmarker__ = []
-    def __getreadonly__(cls, key, default=__getmarker__):
+    def __getreadonly__(self, key, default=__getmarker__):
         """\
         Get a value (even if mutable) which you promise not to change.
         """
-        return cls.__getitem__(key, default, True)
+        return self.__getitem__(key, default, True)
 
-    def __getitem__(cls, key, default=__getmarker__, readonly=False):
-        try:
+    def __getitem__(self, key, default=__getmarker__, readonly=False):
+        value = self.__found.get(key, _notfound)
+        if value is _notfound:
             try:
-                value = getattr(cls, key)
-            except AttributeError:
-                value = cls.__getmutable__(key, readonly)
-
-            # This is for values which have been deleted
-            if value is cls.__marker__:
-                raise AttributeError("key %s does not exist." % key)
+                value = self.__found[key] = _lookup(self.__root, _hash(key), key)
+            except KeyError:
+                if not default is self.__getmarker__:
+                    return default
+                raise
 
+        if readonly or type(value) in _immutable or isinstance(value, ImmutableTypes):
             return value
-        except AttributeError as e:
-            if not default is cls.__getmarker__:
-                return default
+        return self.__getmutable__(key, value)
 
-            raise KeyError(str(e))
-
-    def __delitem__(cls, key):
-        cls.__setitem__(key, cls.__marker__)
-
-    def __revertitem__(cls, key):
-        if not cls.__dict__.has_key(key):
-            key += MUTABLE
-        delattr(cls, key)
-
-    def __contains__(cls, key):
-        return cls.has_key(key)
+    def __delitem__(self, key):
+        try:
+            self.__root = _without(self.__root, 0, _hash(key), key)
+        except KeyError:
+            return
+        self.__len -= 1
+        self.__found.pop(key, None)
+        self.__owned.discard(key)
 
-    def has_key(cls, key):
-        value = cls.__getreadonly__(key, cls.__marker__)
-        if value is cls.__marker__:
+    def __revertitem__(self, key):
+        """Restore the value key had when this level was copied"""
+        try:
+            value = _lookup(self.__parent, _hash(key), key)
+        except KeyError:
+            self.__delitem__(key)
+            return
+        self.__root, added = _assoc(self.__root, 0, _hash(key), key, value)
+        if added:
+            self.__len += 1
+        self.__found[key] = value
+        self.__owned.discard(key)
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+    def has_key(self, key):
+        value = self.__getreadonly__(key, _notfound)
+        if value is _notfound:
             return False
         return True
 
-    def iter(cls, type, readonly=False):
-        for key in dir(cls):
-            if key.startswith("__"):
-                continue
-
-            if key.endswith(MUTABLE):
-                key = key[:-len(MUTABLE)]
-
+    def iter(self, type, readonly=False):
+        for key, value in sorted(_iterate(self.__root)):
             if type == "keys":
                 yield key
-
-            try:
-                if readonly:
-                    value = cls.__getreadonly__(key)
-                else:
-                    value = cls[key]
-            except KeyError:
                 continue
 
+            if not readonly and not isinstance(value, ImmutableTypes):
+                value = self.__getmutable__(key, value)
+
             if type == "values":
                 yield value
             if type == "items":
                 yield (key, value)
-        raise StopIteration()
-
-    def iterkeys(cls):
-        return cls.iter("keys")
-    def itervalues(cls, readonly=False):
-        if not cls.__warn__ is False and cls.__hasmutable__ and readonly is False:
-            print("Warning: If you arn't going to change any of the values call with True.", file=cls.__warn__)
-        return cls.iter("values", readonly)
-    def iteritems(cls, readonly=False):
-        if not cls.__warn__ is False and cls.__hasmutable__ and readonly is False:
-            print("Warning: If you arn't going to change any of the values call with True.", file=cls.__warn__)
-        return cls.iter("items", readonly)
+
+    def iterkeys(self):
+        return self.iter("keys")
+    def itervalues(self, readonly=False):
+        if not self.__warn__ is False and self.__hasmutable__ and readonly is False:
+            print("Warning: If you arn't going to change any of the values call with True.", file=self.__warn__)
+        return self.iter("values", readonly)
+    def iteritems(self, readonly=False):
+        if not self.__warn__ is False and self.__hasmutable__ and readonly is False:
+            print("Warning: If you arn't going to change any of the values call with True.", file=self.__warn__)
+        return self.iter("items", readonly)
 
 class COWSetMeta(COWDictMeta):
-    def __str__(cls):
-        # FIXME: I have magic numbers!
-        return "<COWSet Level: %i Current Keys: %i>" % (cls.__count__, len(cls.__dict__) -3)
+    def __str__(self):
+        return "<COWSet Level: %i Current Keys: %i>" % (self.__count__, len(self))
     __repr__ = __str__
 
-    def cow(cls):
-        class C(cls):
-            __count__ = cls.__count__ + 1
-        return C
-
-    def add(cls, value):
-        COWDictMeta.__setitem__(cls, repr(hash(value)), value)
+    def add(self, value):
+        COWDictMeta.__setitem__(self, value, value)
 
-    def remove(cls, value):
-        COWDictMeta.__delitem__(cls, repr(hash(value)))
+    def remove(self, value):
+        COWDictMeta.__delitem__(self, value)
 
-    def __in__(cls, value):
-        return COWDictMeta.has_key(repr(hash(value)))
-
-    def iterkeys(cls):
+    def iterkeys(self):
         raise TypeError("sets don't have keys")
 
-    def iteritems(cls):
+    def iteritems(self):
         raise TypeError("sets don't have 'items'")
 
-# These are the actual classes you use!
-class COWDictBase(object):
-    __metaclass__ = COWDictMeta
-    __count__ = 0
-
-class COWSetBase(object):
-    __metaclass__ = COWSetMeta
-    __count__ = 0
+# These are the actual objects you use! Like the classes they used to be,
+# calling them or their copy() method returns a new copy on write level.
+COWDictBase = COWDictMeta()
+COWSetBase = COWSetMeta()
 
 if __name__ == "__main__":
     import sys
@@ -246,6 +402,8 @@ if __name__ == "__main__":
     a['set'].add("o1")
     a['set'].add("o1")
     a['set'].add("o2")
+    # Copies are snapshots, b only sees the set when copied again
+    b = a.copy()
 
     print("a", a)
     for x in a['set'].itervalues():
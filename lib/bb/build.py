@@ -727,6 +727,7 @@ def add_tasks(tasklist, d):
         getTask('fakeroot')
         getTask('noexec')
         getTask('umask')
+        getTask('resources')
         task_deps['parents'][task] = []
         if 'deps' in flags:
             for dep in flags['deps']:
@@ -30,8 +30,13 @@
 
 
 import os
+import sys
+import stat
+import time
+import mmap
+import struct
 import logging
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import bb.utils
 
 logger = logging.getLogger("BitBake.Cache")
@@ -43,11 +48,132 @@ except ImportError:
     logger.info("Importing cPickle failed. "
                 "Falling back to a very slow implementation.")
 
-__cache_version__ = "148"
+__cache_version__ = "150"
+
+# Each cache file starts with a fixed size header holding a magic string
+# and the offset and length of the pickled index. The index maps every key
+# to the (offset, length) of its pickled record within the file.
+__cache_magic__ = "BBCACHE1"
+__cache_header__ = struct.Struct("!8sQQ")
 
 def getCacheFile(path, filename, data_hash):
     return os.path.join(path, filename + "." + data_hash)
 
+class IndexedCacheFile(object):
+    """
+    Read access to an indexed cache file. Only the index is unpickled
+    when the file is opened, records are unpickled from a memory map
+    the first time they are requested.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = {}
+        self.map = None
+        self.inode = None
+
+    def open(self):
+        """
+        Map the file and load its index, returning the cache and bitbake
+        versions it was written with. Raises ValueError if the file is
+        not a valid cache file.
+        """
+        with open(self.filename, "rb") as f:
+            header = f.read(__cache_header__.size)
+            if len(header) != __cache_header__.size:
+                raise ValueError("Truncated cache file %s" % self.filename)
+            magic, offset, length = __cache_header__.unpack(header)
+            if magic != __cache_magic__:
+                raise ValueError("Unknown cache file format in %s" % self.filename)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.inode = os.fstat(f.fileno()).st_ino
+        if offset + length > len(self.map):
+            raise ValueError("Truncated cache file %s" % self.filename)
+        cache_ver, bitbake_ver, self.index = pickle.loads(self.map[offset:offset + length])
+        return cache_ver, bitbake_ver
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        self.index = {}
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def raw(self, key):
+        offset, length = self.index[key]
+        return self.map[offset:offset + length]
+
+    def load(self, key):
+        return pickle.loads(self.raw(key))
+
+def write_cachefile(filename, records):
+    """
+    Write an indexed cache file from records, an iterable of (key, data)
+    pairs where data is the already pickled record. The file is written
+    under a temporary name and renamed into place so readers never see
+    a partially written cache.
+    """
+    index = {}
+    tmpname = "%s.%s.tmp" % (filename, os.getpid())
+    with open(tmpname, "wb") as f:
+        f.write(__cache_header__.pack(__cache_magic__, 0, 0))
+        offset = __cache_header__.size
+        for key, data in records:
+            f.write(data)
+            index[key] = (offset, len(data))
+            offset += len(data)
+        data = pickle.dumps((__cache_version__, bb.__version__, index), pickle.HIGHEST_PROTOCOL)
+        f.write(data)
+        f.seek(0)
+        f.write(__cache_header__.pack(__cache_magic__, offset, len(data)))
+    os.rename(tmpname, filename)
+
+def append_cachefile(cachefile, records, removed, compact_ratio):
+    """
+    Update the indexed cache file in place by appending records, an
+    iterable of (key, data) pairs, and a new index which drops the
+    removed keys. The header is only rewritten once the new records and
+    index are in place so an interrupted update leaves the previous index
+    valid. Keys in removed are dropped from the index before the records
+    are added. Returns False without touching the file if it changed since it
+    was mapped or if the ratio of dead bytes in the file would exceed
+    compact_ratio, in which case the caller should rewrite it instead.
+    """
+    index = dict((key, value) for key, value in cachefile.index.iteritems() if key not in removed)
+    records = list(records)
+    for key, _ in records:
+        index.pop(key, None)
+
+    with open(cachefile.filename, "r+b") as f:
+        st = os.fstat(f.fileno())
+        if st.st_ino != cachefile.inode or st.st_size != len(cachefile.map):
+            return False
+
+        offset = st.st_size
+        for key, data in records:
+            index[key] = (offset, len(data))
+            offset += len(data)
+        indexdata = pickle.dumps((__cache_version__, bb.__version__, index), pickle.HIGHEST_PROTOCOL)
+
+        total = offset + len(indexdata)
+        live = __cache_header__.size + len(indexdata) + sum(length for _, length in index.itervalues())
+        if float(total - live) / total > compact_ratio:
+            return False
+
+        f.seek(st.st_size)
+        for key, data in records:
+            f.write(data)
+        f.write(indexdata)
+        f.flush()
+        f.seek(0)
+        f.write(__cache_header__.pack(__cache_magic__, offset, len(indexdata)))
+    return True
+
 # RecipeInfoCommon defines common data retrieving methods
 # from meta data for caches. CoreRecipeInfo as well as other
 # Extra RecipeInfo needs to inherit this class
@@ -253,6 +379,104 @@ class CoreRecipeInfo(RecipeInfoCommon):
         cachedata.fakerootdirs[fn] = self.fakerootdirs
 
 
+class RecipeInfoStore(object):
+    """
+    Mapping of virtual filenames to info arrays backed by the indexed
+    cache files. Entries are only unpickled when they are looked up, new
+    or modified entries are kept in memory until the cache is synced.
+    """
+
+    def __init__(self, classnames):
+        self.classnames = classnames
+        self.files = {}
+        self.loaded = {}
+        self.dirty = set()
+        self.removed = set()
+
+    def add_file(self, classname, cachefile):
+        self.files[classname] = cachefile
+
+    def close(self):
+        for cachefile in self.files.itervalues():
+            cachefile.close()
+        self.files = {}
+
+    def _ondisk(self, key):
+        core = self.files.get(self.classnames[0])
+        return core is not None and key in core and key not in self.removed
+
+    def __contains__(self, key):
+        return key in self.loaded or self._ondisk(key)
+
+    has_key = __contains__
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            return self.loaded[key]
+        if not self._ondisk(key):
+            raise KeyError(key)
+        info_array = []
+        for classname in self.classnames:
+            cachefile = self.files.get(classname)
+            if cachefile is not None and key in cachefile:
+                info_array.append(cachefile.load(key))
+        self.loaded[key] = info_array
+        return info_array
+
+    def __setitem__(self, key, info_array):
+        # Entries loaded from the cache files are stored back unchanged
+        if self.loaded.get(key) is info_array:
+            return
+        self.loaded[key] = info_array
+        self.dirty.add(key)
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.loaded.pop(key, None)
+        self.dirty.discard(key)
+        self.removed.add(key)
+
+    def __len__(self):
+        return len(list(self.iterkeys()))
+
+    def iterkeys(self):
+        for key in self.loaded:
+            yield key
+        core = self.files.get(self.classnames[0])
+        if core is not None:
+            for key in core.keys():
+                if key not in self.loaded and key not in self.removed:
+                    yield key
+
+    __iter__ = iterkeys
+
+    def dirty_records(self, classname):
+        """
+        Yield (key, pickled record) pairs for classname for the entries
+        which were added or modified since the cache files were loaded.
+        """
+        for key in self.dirty:
+            for info in self.loaded[key]:
+                if info.__class__.__name__ == classname:
+                    yield key, pickle.dumps(info, pickle.HIGHEST_PROTOCOL)
+
+    def records(self, classname):
+        """
+        Yield (key, pickled record) pairs for classname. Records which
+        were not modified are copied from the existing file without
+        being pickled again.
+        """
+        cachefile = self.files.get(classname)
+        for key in self.iterkeys():
+            if key not in self.dirty:
+                if cachefile is not None and key in cachefile:
+                    yield key, cachefile.raw(key)
+                continue
+            for info in self.loaded[key]:
+                if info.__class__.__name__ == classname:
+                    yield key, pickle.dumps(info, pickle.HIGHEST_PROTOCOL)
 
 class Cache(object):
     """
@@ -267,11 +491,15 @@ class Cache(object):
         self.cachedir = data.getVar("CACHE", True)
         self.clean = set()
         self.checked = set()
-        self.depends_cache = {}
+        self.missing_files = set()
+        self.parse_times = {}
+        self.depends_cache = RecipeInfoStore([cache_class.__name__ for cache_class in caches_array
+                                              if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon)])
         self.data = None
         self.data_fn = None
         self.cacheclean = True
         self.data_hash = data_hash
+        self.compact_ratio = float(data.getVar("BB_CACHE_COMPACT_RATIO", True) or 0.5)
 
         if self.cachedir in [None, '']:
             self.has_cache = False
@@ -298,62 +526,42 @@ class Cache(object):
             logger.info("Out of date cache found, rebuilding...")
 
     def load_cachefile(self):
-        # Firstly, using core cache file information for
-        # valid checking
-        with open(self.cachefile, "rb") as cachefile:
-            pickled = pickle.Unpickler(cachefile)
+        # Only the indexes are read here, the recipe information
+        # itself is unpickled on demand as the cache is consulted
+        cachefiles = []
+        cachesize = 0
+        for cache_class in self.caches_array:
+            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
+                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
+                cachefiles.append((cache_class.__name__, cachefile))
+                cachesize += os.path.getsize(cachefile)
+
+        bb.event.fire(bb.event.CacheLoadStarted(cachesize), self.data)
+
+        current_progress = 0
+        for cache_class_name, cachefile in cachefiles:
+            indexed = IndexedCacheFile(cachefile)
             try:
-                cache_ver = pickled.load()
-                bitbake_ver = pickled.load()
+                cache_ver, bitbake_ver = indexed.open()
             except Exception:
+                indexed.close()
+                self.depends_cache.close()
                 logger.info('Invalid cache, rebuilding...')
                 return
 
-            if cache_ver != __cache_version__:
-                logger.info('Cache version mismatch, rebuilding...')
-                return
-            elif bitbake_ver != bb.__version__:
-                logger.info('Bitbake version mismatch, rebuilding...')
+            if cache_ver != __cache_version__ or bitbake_ver != bb.__version__:
+                indexed.close()
+                self.depends_cache.close()
+                if cache_ver != __cache_version__:
+                    logger.info('Cache version mismatch, rebuilding...')
+                else:
+                    logger.info('Bitbake version mismatch, rebuilding...')
                 return
 
-
-        cachesize = 0
-        previous_progress = 0
-        previous_percent = 0
-
-        # Calculate the correct cachesize of all those cache files
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    cachesize += os.fstat(cachefile.fileno()).st_size
-
-        bb.event.fire(bb.event.CacheLoadStarted(cachesize), self.data)
-        
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    pickled = pickle.Unpickler(cachefile)                    
-                    while cachefile:
-                        try:
-                            key = pickled.load()
-                            value = pickled.load()
-                        except Exception:
-                            break
-                        if self.depends_cache.has_key(key):
-                            self.depends_cache[key].append(value)
-                        else:
-                            self.depends_cache[key] = [value]
-                        # only fire events on even percentage boundaries
-                        current_progress = cachefile.tell() + previous_progress
-                        current_percent = 100 * current_progress / cachesize
-                        if current_percent > previous_percent:
-                            previous_percent = current_percent
-                            bb.event.fire(bb.event.CacheLoadProgress(current_progress, cachesize),
-                                          self.data)
-
-                    previous_progress += current_progress
+            self.depends_cache.add_file(cache_class_name, indexed)
+            current_progress += os.path.getsize(cachefile)
+            bb.event.fire(bb.event.CacheLoadProgress(current_progress, cachesize),
+                          self.data)
 
         # Note: depends cache number is corresponding to the parsing file numbers.
         # The same file has several caches, still regarded as one item in the cache
@@ -361,7 +569,6 @@ class Cache(object):
                                                   len(self.depends_cache)),
                       self.data)
 
-    
     @staticmethod
     def virtualfn2realfn(virtualfn):
         """
@@ -404,6 +611,7 @@ class Cache(object):
     def parse(cls, filename, appends, configdata, caches_array):
         """Parse the specified filename, returning the recipe information"""
         infos = []
+        start = time.time()
         datastores = cls.load_bbfile(filename, appends, configdata)
         depends = []
         for variant, data in sorted(datastores.iteritems(),
@@ -421,6 +629,12 @@ class Cache(object):
                     info_array.append(info)
             infos.append((virtualfn, info_array))
 
+        # Record how long the whole file took so that future parses can
+        # schedule the most expensive recipes first
+        parsetime = time.time() - start
+        for virtualfn, info_array in infos:
+            info_array[0].parsetime = parsetime
+
         return infos
 
     def load(self, filename, appends, configdata):
@@ -493,70 +707,113 @@ class Cache(object):
             logger.debug(2, "Cache: %s is not cached", fn)
             return False
 
-        mtime = bb.parse.cached_mtime_noerror(fn)
+        if not self.dependsValid(fn, appends):
+            self.remove(fn)
+            return False
+
+        return self.variantsValid(fn)
+
+    def file_mtime(self, f):
+        if f in self.missing_files:
+            return 0
+        return bb.parse.cached_mtime_noerror(f)
+
+    def prefetchDepends(self, items, num_threads):
+        """
+        Stat the recipes in items and all of their file dependencies in
+        one batch, deduplicating the paths shared between recipes.
+        """
+        files = []
+        for fn, appends in items:
+            files.append(fn)
+            if fn in self.depends_cache:
+                depends = self.depends_cache[fn][0].file_depends
+                if depends:
+                    files.extend(f for f, _ in depends)
+        self.missing_files = bb.parse.prefetch_mtimes(files, num_threads)
+
+    def dependsValid(self, fn, appends):
+        """
+        Check the timestamps, dependencies and appends of the cached
+        entry for fn against the filesystem. This doesn't modify the
+        cache so it can be run in parallel in several processes.
+        """
+        mtime = self.file_mtime(fn)
 
         # Check file still exists
         if mtime == 0:
             logger.debug(2, "Cache: %s no longer exists", fn)
-            self.remove(fn)
             return False
 
         info_array = self.depends_cache[fn]
         # Check the file's timestamp
         if mtime != info_array[0].timestamp:
             logger.debug(2, "Cache: %s changed", fn)
-            self.remove(fn)
             return False
 
         # Check dependencies are still valid
         depends = info_array[0].file_depends
         if depends:
             for f, old_mtime in depends:
-                fmtime = bb.parse.cached_mtime_noerror(f)
+                fmtime = self.file_mtime(f)
                 # Check if file still exists
                 if old_mtime != 0 and fmtime == 0:
                     logger.debug(2, "Cache: %s's dependency %s was removed",
                                     fn, f)
-                    self.remove(fn)
                     return False
 
                 if (fmtime != old_mtime):
                     logger.debug(2, "Cache: %s's dependency %s changed",
                                     fn, f)
-                    self.remove(fn)
                     return False
 
-        if hasattr(info_array[0], 'file_checksums'):
-            for _, fl in info_array[0].file_checksums.items():
-                fl = fl.strip()
-                while fl:
-                    # A .split() would be simpler but means spaces or colons in filenames would break
-                    a = fl.find(":True")
-                    b = fl.find(":False")
-                    if ((a < 0) and b) or ((b > 0) and (b < a)):
-                       f = fl[:b+6]
-                       fl = fl[b+7:]
-                    elif ((b < 0) and a) or ((a > 0) and (a < b)):
-                       f = fl[:a+5]
-                       fl = fl[a+6:]
-                    else:
-                       break
-                    fl = fl.strip()
-                    if "*" in f:
-                        continue
-                    f, exist = f.split(":")
-                    if (exist == "True" and not os.path.exists(f)) or (exist == "False" and os.path.exists(f)):
-                        logger.debug(2, "Cache: %s's file checksum list file %s changed",
-                                        fn, f)
-                        self.remove(fn)
-                        return False
+        if not self.fileChecksumsValid(fn, info_array):
+            return False
 
         if appends != info_array[0].appends:
             logger.debug(2, "Cache: appends for %s changed", fn)
             logger.debug(2, "%s to %s" % (str(appends), str(info_array[0].appends)))
-            self.remove(fn)
             return False
 
+        return True
+
+    def fileChecksumsValid(self, fn, info_array):
+        """
+        Check that the files listed in the file checksums of the cached
+        entry for fn still exist, or are still missing, as they were.
+        """
+        if not hasattr(info_array[0], 'file_checksums'):
+            return True
+        for _, fl in info_array[0].file_checksums.items():
+            fl = fl.strip()
+            while fl:
+                # A .split() would be simpler but means spaces or colons in filenames would break
+                a = fl.find(":True")
+                b = fl.find(":False")
+                if ((a < 0) and b) or ((b > 0) and (b < a)):
+                   f = fl[:b+6]
+                   fl = fl[b+7:]
+                elif ((b < 0) and a) or ((a > 0) and (a < b)):
+                   f = fl[:a+5]
+                   fl = fl[a+6:]
+                else:
+                   break
+                fl = fl.strip()
+                if "*" in f:
+                    continue
+                f, exist = f.split(":")
+                if (exist == "True" and not os.path.exists(f)) or (exist == "False" and os.path.exists(f)):
+                    logger.debug(2, "Cache: %s's file checksum list file %s changed",
+                                    fn, f)
+                    return False
+        return True
+
+    def variantsValid(self, fn):
+        """
+        Mark fn and its variants as clean if all of the variants are
+        present in the cache.
+        """
+        info_array = self.depends_cache[fn]
         invalid = False
         for cls in info_array[0].variants:
             virtualfn = self.realfn2virtual(fn, cls)
@@ -580,6 +837,81 @@ class Cache(object):
         self.clean.add(fn)
         return True
 
+    def cacheValidUnmodified(self, fn, appends):
+        """
+        Is the cache valid for fn, given that none of the files it depends
+        on changed since it was last validated? Only the appends, the
+        presence of the variants and the file checksum lists, which
+        aren't watched, are checked.
+        """
+        if not self.has_cache:
+            return False
+
+        self.checked.add(fn)
+
+        if not fn in self.depends_cache:
+            logger.debug(2, "Cache: %s is not cached", fn)
+            return False
+
+        if appends != self.depends_cache[fn][0].appends:
+            logger.debug(2, "Cache: appends for %s changed", fn)
+            self.remove(fn)
+            return False
+
+        if not self.fileChecksumsValid(fn, self.depends_cache[fn]):
+            self.remove(fn)
+            return False
+
+        return self.variantsValid(fn)
+
+    def cacheValidMany(self, items, num_processes):
+        """
+        Run the thorough cache checks for items, a list of (fn, appends)
+        pairs. The entries are split into shards by a hash of the filename
+        and the shards are checked in parallel by num_processes processes.
+        """
+        if not self.has_cache:
+            return
+
+        items = [(fn, appends) for (fn, appends) in items if fn not in self.checked]
+        # Forking only pays off when there are a reasonable number of
+        # entries to check in each process
+        if num_processes < 2 or len(items) < num_processes * 50:
+            self.prefetchDepends(items, _prefetch_threads)
+            for fn, appends in items:
+                self.cacheValidUpdate(fn, appends)
+            self.missing_files = set()
+            return
+
+        shards = [[] for i in range(num_processes)]
+        for fn, appends in items:
+            if fn in self.depends_cache:
+                shards[hash(fn) % num_processes].append((fn, appends))
+
+        global _validating_cache
+        _validating_cache = self
+        pool = bb.utils.multiprocessingpool(num_processes)
+        try:
+            valid = set()
+            for shard_valid in pool.map(_dependsValidShard, shards):
+                valid.update(shard_valid)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _validating_cache = None
+
+        for fn, appends in items:
+            self.checked.add(fn)
+            if not fn in self.depends_cache:
+                logger.debug(2, "Cache: %s is not cached", fn)
+            elif fn not in valid:
+                self.remove(fn)
+            else:
+                self.variantsValid(fn)
+
     def remove(self, fn):
         """
         Remove a fn from the cache
@@ -587,6 +919,9 @@ class Cache(object):
         """
         if fn in self.depends_cache:
             logger.debug(1, "Removing %s from cache", fn)
+            parsetime = getattr(self.depends_cache[fn][0], "parsetime", None)
+            if parsetime is not None:
+                self.parse_times[fn] = parsetime
             del self.depends_cache[fn]
         if fn in self.clean:
             logger.debug(1, "Marking %s as unclean", fn)
@@ -605,31 +940,26 @@ class Cache(object):
             logger.debug(2, "Cache is clean, not saving.")
             return
 
-        file_dict = {}
-        pickler_dict = {}
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cache_class_name = cache_class.__name__
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                file_dict[cache_class_name] = open(cachefile, "wb")
-                pickler_dict[cache_class_name] =  pickle.Pickler(file_dict[cache_class_name], pickle.HIGHEST_PROTOCOL)
-                   
-        pickler_dict['CoreRecipeInfo'].dump(__cache_version__)
-        pickler_dict['CoreRecipeInfo'].dump(bb.__version__)
-
+        # Existing cache files are updated by appending the changed
+        # entries, they are only rewritten in full once enough of their
+        # contents is stale
+        glf = bb.utils.lockfile(self.cachefile + ".lock")
         try:
-            for key, info_array in self.depends_cache.iteritems():
-                for info in info_array:
-                    if isinstance(info, RecipeInfoCommon):
-                        cache_class_name = info.__class__.__name__
-                        pickler_dict[cache_class_name].dump(key)
-                        pickler_dict[cache_class_name].dump(info)
-        finally:
             for cache_class in self.caches_array:
                 if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
                     cache_class_name = cache_class.__name__
-                    file_dict[cache_class_name].close()
+                    cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
+                    indexed = self.depends_cache.files.get(cache_class_name)
+                    if indexed and append_cachefile(indexed, self.depends_cache.dirty_records(cache_class_name),
+                                                    self.depends_cache.removed | self.depends_cache.dirty,
+                                                    self.compact_ratio):
+                        continue
+                    logger.debug(1, "Writing cache file %s", cachefile)
+                    write_cachefile(cachefile, self.depends_cache.records(cache_class_name))
+        finally:
+            bb.utils.unlockfile(glf)
 
+        self.depends_cache.close()
         del self.depends_cache
 
     @staticmethod
@@ -701,6 +1031,19 @@ class Cache(object):
             raise
 
 
+_validating_cache = None
+# Number of threads used to stat the dependencies of each shard, stat()
+# mostly waits on the filesystem so this is independent of the CPU count
+_prefetch_threads = 8
+
+def _dependsValidShard(shard):
+    """
+    Check one shard of entries against the cache inherited from the parent
+    process, returning the filenames which are still valid.
+    """
+    _validating_cache.prefetchDepends(shard, _prefetch_threads)
+    return [fn for (fn, appends) in shard if _validating_cache.dependsValid(fn, appends)]
+
 def init(cooker):
     """
     The Objective: Cache the minimum amount of data possible yet get to the
@@ -745,6 +1088,158 @@ class CacheData(object):
         for info in info_array:
             info.add_cacheData(self, fn)
 
+class RecipeDataCache(object):
+    """
+    A least recently used cache of the complete datastores returned by
+    Cache.loadDataFull(), so each task of a recipe doesn't need to parse it
+    again. The cache is bounded by an estimate of the memory the datastores
+    hold on top of the configuration and an entry is parsed again when any
+    of the files it was parsed from has changed.
+
+    Parsing a recipe changes the bb.utils context and the event handlers,
+    so those are kept with each datastore and set up again whenever it is
+    returned. As parsing blocks the caller, recipes which aren't cached are
+    only recorded by get() and parsed later by fill().
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.pending = OrderedDict()
+        # The state of the configuration every parse starts from
+        self.context = dict(bb.utils.get_context())
+        self.handlers = bb.event.get_class_handlers().copy()
+
+    def get(self, virtualfn, appends):
+        """
+        Return the cached datastore for virtualfn with the context and event
+        handlers it was parsed with set up. If there isn't one, set up those
+        of the configuration, record virtualfn for fill() and return None.
+        """
+        key = (virtualfn, tuple(appends))
+        entry = self.entries.pop(key, None)
+        if entry:
+            if self.dependsValid(entry[1]):
+                self.entries[key] = entry
+                self.setState(entry[3], entry[4])
+                return entry[0]
+            logger.debug(1, "Files used by %s have changed, parsing it again", virtualfn)
+            self.size -= entry[2]
+            self.dropSignatureData([virtualfn])
+
+        self.pending.pop(key, None)
+        self.pending[key] = True
+        self.setState(self.context, self.handlers)
+        return None
+
+    def fill(self, cfgData):
+        """
+        Parse the recipe get() most recently missed into the cache, return
+        False when there was nothing to parse.
+        """
+        while self.pending:
+            key, _ = self.pending.popitem()
+            if key not in self.entries:
+                self.loadDataFull(key[0], list(key[1]), cfgData)
+                return True
+        return False
+
+    def loadDataFull(self, virtualfn, appends, cfgData):
+        """Return the datastore for virtualfn, parsing it if it isn't cached"""
+        the_data = self.get(virtualfn, appends)
+        if the_data is not None:
+            return the_data
+
+        key = (virtualfn, tuple(appends))
+        self.pending.pop(key, None)
+        # The parse sets a few variables in the configuration it is given
+        the_data = Cache.loadDataFull(virtualfn, appends, cfgData.createCopy())
+        depends = the_data.getVar("__depends", False) or []
+        size = self.datastoreSize(the_data, cfgData)
+        if size <= self.budget:
+            self.entries[key] = (the_data, list(depends), size,
+                                 dict(bb.utils.get_context()),
+                                 bb.event.get_class_handlers().copy())
+            self.size += size
+            while self.size > self.budget:
+                oldkey, oldentry = self.entries.popitem(last=False)
+                self.size -= oldentry[2]
+                self.dropSignatureData([oldkey[0]])
+
+        # All the variants of the recipe were finalised by the parse
+        realfn = Cache.virtualfn2realfn(virtualfn)[0]
+        taskdeps = getattr(bb.parse.siggen, "taskdeps", {})
+        self.dropSignatureData([fn for fn in taskdeps
+                                if Cache.virtualfn2realfn(fn)[0] == realfn])
+        return the_data
+
+    def dropSignatureData(self, virtualfns):
+        """
+        Drop the data the signature generator kept from the parses of
+        virtualfns, except for those with a cached datastore whose tasks
+        still write out their signatures from it. The tasks of the other
+        recipes parse them again, which generates the data again.
+        """
+        siggen = bb.parse.siggen
+        if not hasattr(siggen, "taskdeps"):
+            return
+        held = set(key[0] for key in self.entries)
+        for fn in virtualfns:
+            if fn in held:
+                continue
+            for task in siggen.taskdeps.pop(fn, {}):
+                siggen.basehash.pop(fn + "." + task, None)
+            siggen.gendeps.pop(fn, None)
+            siggen.lookupcache.pop(fn, None)
+
+    @staticmethod
+    def setState(context, handlers):
+        # Functions defined by a parse use the context as their globals,
+        # so it has to be changed in place
+        ctx = bb.utils.get_context()
+        ctx.clear()
+        ctx.update(context)
+        bb.event.set_class_handlers(handlers.copy())
+
+    @staticmethod
+    def dependsValid(depends):
+        """
+        Check the files a datastore was parsed from against the filesystem,
+        the mtime cache of this process would never see the changes.
+        """
+        valid = True
+        for f, old_mtime in depends:
+            try:
+                mtime = os.stat(f)[stat.ST_MTIME]
+            except OSError:
+                mtime = 0
+            if mtime != old_mtime:
+                bb.parse.update_cache(f)
+                valid = False
+        return valid
+
+    @staticmethod
+    def datastoreSize(d, cfgData):
+        """
+        Estimate the memory held by d which isn't shared with cfgData, the
+        variables it only found in the configuration don't count.
+        """
+        getsizeof = sys.getsizeof
+        size = 0
+        base = cfgData.dict
+        dest = d.dict
+        while dest and dest is not base:
+            size += getsizeof(dest)
+            for var, vardict in dest.iteritems():
+                if var == "_data" or cfgData._findVar(var) is vardict:
+                    continue
+                size += getsizeof(vardict)
+                for value in vardict.itervalues():
+                    size += getsizeof(value)
+            dest = dest.get("_data")
+        return size
+
 class MultiProcessCache(object):
     """
     BitBake multi-process cache implementation
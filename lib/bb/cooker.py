@@ -189,15 +189,29 @@ class BBCooker:
     def config_notifications(self, event):
         if not event.pathname in self.configwatcher.bbwatchedfiles:
             return
-        if not event.path in self.inotify_modified_files:
-            self.inotify_modified_files.append(event.path)
+        if not event.pathname in self.inotify_modified_files:
+            self.inotify_modified_files.append(event.pathname)
         self.baseconfig_valid = False
 
     def notifications(self, event):
-        if not event.path in self.inotify_modified_files:
-            self.inotify_modified_files.append(event.path)
+        if not event.pathname in self.inotify_modified_files:
+            self.inotify_modified_files.append(event.pathname)
         self.parsecache_valid = False
 
+    def recipes_affected_by(self, path):
+        """
+        Return the recipes whose parsing depended on path, or on a file
+        below path if it is a directory which was created or removed.
+        """
+        if path in self.depends_index:
+            return self.depends_index[path]
+        affected = set()
+        prefix = path + "/"
+        for f, recipes in self.depends_index.iteritems():
+            if f.startswith(prefix):
+                affected |= recipes
+        return affected
+
     def add_filewatch(self, deps, watcher=None):
         if not watcher:
             watcher = self.watcher
@@ -255,6 +269,12 @@ class BBCooker:
         self.state = state.initial
         self.caches_array = []
 
+        # Recipes whose cache entries were valid at the end of the last
+        # parse and haven't been touched according to inotify since, along
+        # with a map of each file a recipe depends on to those recipes.
+        self.unmodified_recipes = set()
+        self.depends_index = {}
+
         # Need to preserve BB_CONSOLELOG over resets
         consolelog = None
         if hasattr(self, "data"):
@@ -1506,6 +1526,8 @@ class BBCooker:
         # reload files for which we got notifications
         for p in self.inotify_modified_files:
             bb.parse.update_cache(p)
+            bb.parse.BBHandler.cached_statements.pop(p, None)
+            self.unmodified_recipes -= self.recipes_affected_by(p)
         self.inotify_modified_files = []
 
         if not self.baseconfig_valid:
@@ -1550,6 +1572,9 @@ class BBCooker:
             collectlog.debug(1, "parsing complete")
             if self.parser.error:
                 raise bb.BBHandledException()
+            # Only the recipes whose dependencies are watched can be
+            # trusted to be unmodified until inotify says otherwise
+            self.unmodified_recipes = set(self.parser.filelist) - self.parser.unwatched
             self.show_appends_with_no_recipes()
             self.handlePrefProviders()
             self.recipecache.bbfile_priority = self.collection.collection_priorities(self.recipecache.pkg_fn, self.data)
@@ -1884,10 +1909,13 @@ class Feeder(multiprocessing.Process):
             try:
                 self.to_parsers.put(job, timeout=0.5)
             except Queue.Full:
-                self.jobs.insert(0, job)
+                self.jobs.append(job)
                 continue
 
 class Parser(multiprocessing.Process):
+    # Maximum number of parse results sent to the cooker in one message
+    results_batch = 16
+
     def __init__(self, jobs, results, quit, init, profile):
         self.jobs = jobs
         self.results = results
@@ -1897,6 +1925,7 @@ class Parser(multiprocessing.Process):
         self.context = bb.utils.get_context().copy()
         self.handlers = bb.event.get_class_handlers().copy()
         self.profile = profile
+        self.timings = []
 
     def run(self):
 
@@ -1914,12 +1943,18 @@ class Parser(multiprocessing.Process):
         finally:
             logfile = "profile-parse-%s.log" % multiprocessing.current_process().name
             prof.dump_stats(logfile)
+            logfile = "parse-timing-%s.log" % multiprocessing.current_process().name
+            with open(logfile, "w") as f:
+                for filename, start, end in self.timings:
+                    f.write("%f %f %s\n" % (start, end, filename))
 
     def realrun(self):
         if self.init:
             self.init()
 
         pending = []
+        batch = []
+        results = []
         while True:
             try:
                 self.quit.get_nowait()
@@ -1931,15 +1966,27 @@ class Parser(multiprocessing.Process):
 
             if pending:
                 result = pending.pop()
+            elif batch:
+                start = time.time()
+                job = batch.pop()
+                parsed = self.parse(*job)
+                if self.profile:
+                    self.timings.append((job[0], start, time.time()))
+                results.append(parsed)
+                # Errors are sent straight away so the cooker can stop the parse
+                if len(results) < self.results_batch and batch and not isinstance(parsed[1], BaseException):
+                    continue
+                result, results = results, []
             else:
                 try:
-                    job = self.jobs.get(timeout=0.25)
+                    batch = self.jobs.get(timeout=0.25)
                 except Queue.Empty:
                     continue
 
-                if job is None:
+                if batch is None:
                     break
-                result = self.parse(*job)
+                batch.reverse()
+                continue
 
             try:
                 self.results.put(result, timeout=0.25)
@@ -1985,11 +2032,27 @@ class CookerParser(object):
                                  multiprocessing.cpu_count())
         self.process_names = []
 
+        # Recipes which depend on files inotify doesn't watch
+        self.unwatched = set()
+
         self.bb_cache = bb.cache.Cache(self.cfgdata, self.cfghash, cooker.caches_array)
         self.fromcache = []
         self.willparse = []
+        appendsmap = dict((filename, self.cooker.collection.get_file_appends(filename))
+                          for filename in self.filelist)
+        # Recipes which inotify says are unchanged since the last parse
+        # don't need their dependencies stat()ed again
+        tocheck = []
+        for filename in self.filelist:
+            if filename in cooker.unmodified_recipes:
+                self.bb_cache.cacheValidUnmodified(filename, appendsmap[filename])
+            else:
+                tocheck.append((filename, appendsmap[filename]))
+        self.bb_cache.cacheValidMany(tocheck, self.num_processes)
+        cooker.unmodified_recipes = set()
+        cooker.depends_index = {}
         for filename in self.filelist:
-            appends = self.cooker.collection.get_file_appends(filename)
+            appends = appendsmap[filename]
             if not self.bb_cache.cacheValid(filename, appends):
                 self.willparse.append((filename, appends, cooker.caches_array))
             else:
@@ -1997,6 +2060,15 @@ class CookerParser(object):
         self.toparse = self.total - len(self.fromcache)
         self.progress_chunk = max(self.toparse / 100, 1)
 
+        # Order the recipes by how long they took to parse last time so the
+        # most expensive ones don't end up holding up the end of the parse.
+        # Recipes we know nothing about are assumed to take the average.
+        parse_times = self.bb_cache.parse_times
+        known = [parse_times[job[0]] for job in self.willparse if job[0] in parse_times]
+        average = sum(known) / len(known) if known else 0
+        self.parse_costs = dict((job[0], parse_times.get(job[0], average)) for job in self.willparse)
+        self.willparse.sort(key=lambda job: self.parse_costs[job[0]], reverse=True)
+
         self.start()
         self.haveshutdown = False
 
@@ -2005,16 +2077,22 @@ class CookerParser(object):
         self.processes = []
         if self.toparse:
             bb.event.fire(bb.event.ParseStarted(self.toparse), self.cfgdata)
+            # Parse the classes once here so the parser processes inherit
+            # them, the cache survives in the cooker between parses
+            bb.parse.BBHandler.preload_statements(self.cfgdata.getVar("BBPATH", True) or "")
             def init():
                 Parser.cfg = self.cfgdata
+                bb.methodpool.code_cache_forked()
                 multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, args=(self.cfgdata,), exitpriority=1)
+                multiprocessing.util.Finalize(None, bb.parse.ast.statement_cache_save, args=(self.cfgdata,), exitpriority=1)
+                multiprocessing.util.Finalize(None, bb.methodpool.code_cache_save, args=(self.cfgdata,), exitpriority=1)
                 multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, args=(self.cfgdata,), exitpriority=1)
 
             self.feeder_quit = multiprocessing.Queue(maxsize=1)
             self.parser_quit = multiprocessing.Queue(maxsize=self.num_processes)
             self.jobs = multiprocessing.Queue(maxsize=self.num_processes)
             self.result_queue = multiprocessing.Queue()
-            self.feeder = Feeder(self.willparse, self.jobs, self.feeder_quit)
+            self.feeder = Feeder(self.parse_batches(), self.jobs, self.feeder_quit)
             self.feeder.start()
             for i in range(0, self.num_processes):
                 parser = Parser(self.jobs, self.result_queue, self.parser_quit, init, self.cooker.configuration.profile)
@@ -2024,6 +2102,30 @@ class CookerParser(object):
 
             self.results = itertools.chain(self.results, self.parse_generator())
 
+    def parse_batches(self):
+        """
+        Group the recipes to parse into batches handed to the parser
+        processes in one go. Expensive recipes are sent on their own while
+        cheap ones are grouped together so the processes don't spend their
+        time waiting on the job queue. The batches are returned in reverse
+        order since the feeder pops them from the end of the list.
+        """
+        target = sum(self.parse_costs.itervalues()) / (self.num_processes * 20)
+        batches = []
+        batch = []
+        cost = 0
+        for job in self.willparse:
+            batch.append(job)
+            cost += self.parse_costs[job[0]]
+            if cost >= target or len(batch) >= 50:
+                batches.append(batch)
+                batch = []
+                cost = 0
+        if batch:
+            batches.append(batch)
+        batches.reverse()
+        return batches
+
     def shutdown(self, clean=True, force=False):
         if not self.toparse:
             return
@@ -2062,6 +2164,8 @@ class CookerParser(object):
         sync.start()
         multiprocessing.util.Finalize(None, sync.join, exitpriority=-100)
         bb.codeparser.parser_cache_savemerge(self.cooker.data)
+        bb.parse.ast.statement_cache_savemerge(self.cooker.data)
+        bb.methodpool.code_cache_savemerge(self.cooker.data)
         bb.fetch.fetcher_parse_done(self.cooker.data)
         if self.cooker.configuration.profile:
             profiles = []
@@ -2074,6 +2178,35 @@ class CookerParser(object):
             bb.utils.process_profilelog(profiles, pout = pout)
             print("Processed parsing statistics saved to %s" % (pout))
 
+            self.write_timing_report("parse-timing.log")
+            print("Parse timing report saved to parse-timing.log")
+
+    def write_timing_report(self, report):
+        """
+        Merge the per process parse timings into a single report listing,
+        for each recipe, the process which parsed it along with the start
+        and end of the parse relative to the start of the parse phase.
+        """
+        timings = []
+        for i in self.process_names:
+            logfile = "parse-timing-%s.log" % i
+            if not os.path.exists(logfile):
+                continue
+            with open(logfile, "r") as f:
+                for line in f:
+                    start, end, filename = line.rstrip("\n").split(" ", 2)
+                    timings.append((float(start), float(end), i, filename))
+            os.unlink(logfile)
+        if not timings:
+            return
+
+        timings.sort()
+        first = timings[0][0]
+        with open(report, "w") as f:
+            f.write("# start end duration process recipe\n")
+            for start, end, process, filename in timings:
+                f.write("%.3f %.3f %.3f %s %s\n" % (start - first, end - first, end - start, process, filename))
+
     def load_cached(self):
         for filename, appends in self.fromcache:
             cached, infos = self.bb_cache.load(filename, appends, self.cfgdata)
@@ -2085,15 +2218,16 @@ class CookerParser(object):
                 break
 
             try:
-                result = self.result_queue.get(timeout=0.25)
+                results = self.result_queue.get(timeout=0.25)
             except Queue.Empty:
                 pass
             else:
-                value = result[1]
-                if isinstance(value, BaseException):
-                    raise value
-                else:
-                    yield result
+                for result in results:
+                    value = result[1]
+                    if isinstance(value, BaseException):
+                        raise value
+                    else:
+                        yield result
 
     def parse_next(self):
         result = []
@@ -2154,9 +2288,15 @@ class CookerParser(object):
             self.cached += 1
 
         for virtualfn, info_array in result:
+            realfn = bb.cache.Cache.virtualfn2realfn(virtualfn)[0]
+            self.cooker.depends_index.setdefault(realfn, set()).add(realfn)
+            for f, _ in info_array[0].file_depends or []:
+                self.cooker.depends_index.setdefault(f, set()).add(realfn)
             if info_array[0].skipped:
                 self.skipped += 1
                 self.cooker.skiplist[virtualfn] = SkippedPackage(info_array[0])
+                # add_info() doesn't watch the files skipped recipes depend on
+                self.unwatched.add(realfn)
             self.bb_cache.add_info(virtualfn, info_array, self.cooker.recipecache,
                                         parsed=parsed, watcher = self.cooker.add_filewatch)
         return True
@@ -22,13 +22,18 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os, sys
+import os, sys, types
 from functools import wraps
 import logging
 import bb
 from bb import data
 import bb.parse
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 logger      = logging.getLogger("BitBake")
 parselog    = logging.getLogger("BitBake.Parsing")
 
@@ -268,6 +273,7 @@ class CookerDataBuilder(object):
     def parseConfigurationFiles(self, prefiles, postfiles):
         data = self.data
         bb.parse.init_parser(data)
+        bb.methodpool.configmethods = []
 
         # Parse files for loading *before* bitbake.conf and any includes
         for f in prefiles:
@@ -322,6 +328,16 @@ class CookerDataBuilder(object):
         if data.getVar("BB_WORKERCONTEXT", False) is None:
             bb.fetch.fetcher_init(data)
         bb.codeparser.parser_cache_init(data)
+        bb.parse.ast.statement_cache_init(data)
+        bb.methodpool.code_cache_init(data)
+
+        # Keep the parsed configuration and the process state it set up as
+        # they were before the ConfigParsed handlers ran, so
+        # workerConfiguration() can send them to bitbake-worker, which runs
+        # the handlers itself in its own context
+        basedata = data
+        context = dict(bb.utils.get_context())
+        data = bb.data.createCopy(data)
         bb.event.fire(bb.event.ConfigParsed(), data)
 
         if data.getVar("BB_INVALIDCONF", False) is True:
@@ -331,8 +347,104 @@ class CookerDataBuilder(object):
 
         bb.parse.init_parser(data)
         data.setVar('BBINCLUDED',bb.parse.get_file_depends(data))
-        self.data = data
         self.data_hash = data.get_hash()
 
+        self.methods = bb.methodpool.configmethods
+        bb.methodpool.configmethods = None
+        self.context = context
+        self.path = list(sys.path)
+        self.basedata = basedata.freeze()
+        self.workerconfig = None
+        # The cooker works on a copy
+        self.data = bb.data.createCopy(data)
+
+    def workerConfiguration(self):
+        """
+        Return the parsed base configuration serialized for
+        restoreBaseConfiguration(), or None if it cannot be and
+        bitbake-worker has to parse the configuration itself.
+        """
+        if self.workerconfig is not None:
+            return self.workerconfig or None
+
+        context = {}
+        modules = {}
+        for name, value in self.context.iteritems():
+            if name == "__builtins__":
+                continue
+            if isinstance(value, types.ModuleType):
+                modules[name] = value.__name__
+            elif isinstance(value, types.FunctionType) and value.func_globals is bb.utils.get_context():
+                # Defined by one of self.methods
+                continue
+            else:
+                context[name] = value
+        imports = []
+        for modname in modules.itervalues():
+            imports.extend(m for m in sys.modules if sys.modules[m] and (m == modname or m.startswith(modname + ".")))
+
+        try:
+            self.workerconfig = pickle.dumps((self.basedata, self.path, sorted(imports), modules, context, self.methods), -1)
+        except (pickle.PicklingError, TypeError) as exc:
+            logger.debug(1, "Unable to serialize the configuration for bitbake-worker: %s", exc)
+            self.workerconfig = ""
+        return self.workerconfig or None
+
+    def restoreBaseConfiguration(self, config):
+        """
+        Set up the base configuration and the process state for it from
+        the output of workerConfiguration() rather than parsing it. If
+        that fails the process state is put back as it was, so the
+        configuration can be parsed instead.
+        """
+        basedata, path, imports, modules, context, methods = pickle.loads(config)
+
+        oldpath = list(sys.path)
+        oldcontext = dict(bb.utils.get_context())
+        oldhandlers = bb.event.get_class_handlers().copy()
+        try:
+            sys.path[0:0] = [p for p in path if p not in sys.path]
+            for modname in imports:
+                __import__(modname)
+            bb.utils.get_context().update(context)
+            for name, modname in modules.iteritems():
+                bb.utils.get_context()[name] = sys.modules[modname]
+
+            data = bb.data.createCopy(basedata)
+            if self.data.getVar("BB_WORKERCONTEXT", False):
+                data.setVar("BB_WORKERCONTEXT", "1")
+
+            # The methods are compiled from the code cache
+            bb.codeparser.parser_cache_init(data)
+            bb.parse.ast.statement_cache_init(data)
+            bb.methodpool.code_cache_init(data)
+
+            for modulename, code, fn in methods:
+                bb.methodpool.insert_method(modulename, code, fn)
+            for var in data.getVar('__BBHANDLERS', False) or []:
+                bb.event.register(var, data.getVar(var, False),  (data.getVarFlag(var, "eventmask", True) or "").split())
+
+            # The handlers haven't run on the configuration yet, as when
+            # it is parsed
+            bb.parse.init_parser(data)
+            if data.getVar("BB_WORKERCONTEXT", False) is None:
+                bb.fetch.fetcher_init(data)
+            bb.event.fire(bb.event.ConfigParsed(), data)
+            if data.getVar("BB_INVALIDCONF", False) is True:
+                raise ValueError("The configuration has to be parsed again")
+
+            bb.parse.init_parser(data)
+            data.setVar('BBINCLUDED',bb.parse.get_file_depends(data))
+        except:
+            # Modules which were imported stay loaded, nothing refers to them
+            sys.path[:] = oldpath
+            bb.utils.get_context().clear()
+            bb.utils.get_context().update(oldcontext)
+            bb.event.set_class_handlers(oldhandlers)
+            raise
+
+        self.basedata = basedata
+        self.data = data
+
 
 
@@ -28,13 +28,12 @@ BitBake build tools.
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
-import copy, re, sys, traceback
+import copy, re, sys, traceback, itertools
 from collections import MutableMapping
 import logging
 import hashlib
 import bb, bb.codeparser
 from bb   import utils
-from bb.COW  import COWDictBase
 
 logger = logging.getLogger("BitBake.Data")
 
@@ -43,6 +42,33 @@ __setvar_regexp__ = re.compile('(?P<base>.*?)(?P<keyword>_append|_prepend|_remov
 __expand_var_regexp__ = re.compile(r"\${[^{}@\n\t ]+}")
 __expand_python_regexp__ = re.compile(r"\${@.+?}")
 
+# Values split at their ${VAR} references, and ${@...} snippets compiled
+# along with what they reference. These are shared by all datastores since
+# most values come from the same classes.
+__expand_templates__ = {}
+__expand_code__ = {}
+__expand_cache_limit__ = 100000
+
+def expansion_template(s):
+    """
+    Return s split into (literal, variable) pairs for each ${VAR}
+    reference in it, the last pair has None as its variable.
+    """
+    try:
+        return __expand_templates__[s]
+    except KeyError:
+        pass
+    template = []
+    pos = 0
+    for match in __expand_var_regexp__.finditer(s):
+        template.append((s[pos:match.start()], match.group()[2:-1]))
+        pos = match.end()
+    template.append((s[pos:], None))
+    if len(__expand_templates__) > __expand_cache_limit__:
+        __expand_templates__.clear()
+    __expand_templates__[s] = template
+    return template
+
 def infer_caller_details(loginfo, parent = False, varval = True):
     """Save the caller the trouble of specifying everything."""
     # Save effort.
@@ -98,13 +124,18 @@ class VariableParse:
         self.references = set()
         self.execs = set()
         self.contains = {}
+        # Python snippets can read variables we can't see references to
+        self.volatile = False
 
     def var_sub(self, match):
-            key = match.group()[2:-1]
+            return self.var_ref(match.group()[2:-1])
+
+    def var_ref(self, key):
             if self.varname and key:
                 if self.varname == key:
                     raise Exception("variable %s references itself!" % self.varname)
-            if key in self.d.expand_cache:
+            # Flags are cached as var[flag], which isn't a reference to them
+            if key in self.d.expand_cache and not key.endswith("]"):
                 varparse = self.d.expand_cache[key]
                 var = varparse.value
             else:
@@ -113,28 +144,50 @@ class VariableParse:
             if var is not None:
                 return var
             else:
-                return match.group()
+                return "${%s}" % key
+
+    def var_expand(self, s):
+            """Replace the ${VAR} references in s, like var_sub would"""
+            template = expansion_template(s)
+            if len(template) == 1:
+                return s
+            parts = []
+            for literal, key in template:
+                parts.append(literal)
+                if key is not None:
+                    parts.append(self.var_ref(key))
+            return "".join(parts)
 
     def python_sub(self, match):
             code = match.group()[3:-1]
-            codeobj = compile(code.strip(), self.varname or "<expansion>", "eval")
-
-            parser = bb.codeparser.PythonParser(self.varname, logger)
-            parser.parse_python(code)
-            if self.varname:
-                vardeps = self.d.getVarFlag(self.varname, "vardeps", True)
-                if vardeps is None:
+            self.volatile = True
+            key = (code, self.varname)
+            try:
+                codeobj, references, execs, contains = __expand_code__[key]
+            except KeyError:
+                codeobj = compile(code.strip(), self.varname or "<expansion>", "eval")
+
+                parser = bb.codeparser.PythonParser(self.varname, logger)
+                parser.parse_python(code)
+                if self.varname:
+                    vardeps = self.d.getVarFlag(self.varname, "vardeps", True)
+                    if vardeps is None:
+                        parser.log.flush()
+                else:
                     parser.log.flush()
-            else:
-                parser.log.flush()
-            self.references |= parser.references
-            self.execs |= parser.execs
+                references, execs, contains = parser.references, parser.execs, parser.contains
+
+                if len(__expand_code__) > __expand_cache_limit__:
+                    __expand_code__.clear()
+                __expand_code__[key] = (codeobj, references, execs, contains)
+            self.references |= references
+            self.execs |= execs
 
-            for k in parser.contains:
+            for k in contains:
                 if k not in self.contains:
-                    self.contains[k] = parser.contains[k].copy()
+                    self.contains[k] = contains[k].copy()
                 else:
-                    self.contains[k].update(parser.contains[k])
+                    self.contains[k].update(contains[k])
             value = utils.better_eval(codeobj, DataContext(self.d))
             return str(value)
 
@@ -152,6 +205,56 @@ class DataContext(dict):
         else:
             return value
 
+class ExpansionCache(dict):
+    """
+    Expanded values keyed on variable name, or var[flag]. Each entry is
+    recorded against the variables it references so that a change to a
+    variable only drops the entries which depend on it. Entries which ran
+    python are dropped on any change.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.dependents = {}
+        self.volatile = set()
+
+    def add(self, name, varparse):
+        self[name] = varparse
+        refs = set(varparse.references)
+        if name.endswith("]"):
+            refs.add(name[:name.find("[")])
+        self.depends(name, refs, varparse.volatile)
+
+    def depends(self, name, refs, volatile=False):
+        """Record the entry name against further variables it depends on"""
+        for ref in refs:
+            if ref not in self.dependents:
+                self.dependents[ref] = set()
+            self.dependents[ref].add(name)
+        if volatile:
+            self.volatile.add(name)
+
+    def invalidate(self, var):
+        """Drop the entries affected by a change to var"""
+        if not self:
+            return
+        invalid = self.volatile
+        self.volatile = set()
+        invalid.add(var)
+        # Setting FOO_override or FOO_append changes FOO too
+        while "_" in var:
+            var = var[:var.rfind("_")]
+            invalid.add(var)
+        while invalid:
+            name = invalid.pop()
+            self.pop(name, None)
+            if name in self.dependents:
+                invalid |= self.dependents.pop(name)
+
+    def clear(self):
+        dict.clear(self)
+        self.dependents = {}
+        self.volatile = set()
+
 class ExpansionError(Exception):
     def __init__(self, varname, expression, exception):
         self.expression = expression
@@ -169,6 +272,11 @@ class ExpansionError(Exception):
     def __str__(self):
         return self.msg
 
+class FrozenError(Exception):
+    """Exception raised when changing a frozen datastore"""
+    def __init__(self, var):
+        Exception.__init__(self, "Unable to change %s, the datastore is frozen" % var)
+
 class IncludeHistory(object):
     def __init__(self, parent = None, filename = '[TOP LEVEL]'):
         self.parent = parent
@@ -212,16 +320,99 @@ class IncludeHistory(object):
             o.write("\n")
             child.emit(o, level)
 
+def _intern(value):
+    if type(value) is str:
+        return intern(value)
+    return value
+
+class VariableHistoryEvent(object):
+    """
+    A single recorded operation on a variable. Filenames, operations,
+    functions and flags repeat across many events so they are interned,
+    anything else passed to record() is kept in extra.
+    """
+    __slots__ = ("op", "file", "line", "func", "flag", "detail", "extra")
+    interned = ("op", "file", "func", "flag")
+
+    def __init__(self, loginfo):
+        extra = None
+        for k, v in loginfo.iteritems():
+            if k in self.interned:
+                setattr(self, k, _intern(v))
+            elif k == "line" or k == "detail":
+                setattr(self, k, v)
+            elif k != "variable":
+                if extra is None:
+                    extra = {}
+                extra[k] = v
+        self.extra = extra
+
+    def __reduce__(self):
+        return (VariableHistoryEvent, (self.asdict(None),))
+
+    def asdict(self, var):
+        """Return the event in the form passed to record()"""
+        event = {}
+        if var is not None:
+            event['variable'] = var
+        for field in self.__slots__[:-1]:
+            try:
+                event[field] = getattr(self, field)
+            except AttributeError:
+                pass
+        if self.extra:
+            event.update(self.extra)
+        return event
+
 class VariableHistory(object):
+    # Copies share the history recorded before them as read-only levels,
+    # collapsed into one once there are more than this
+    maxlevels = 16
+
     def __init__(self, dataroot):
         self.dataroot = dataroot
-        self.variables = COWDictBase.copy()
+        self.variables = {}
+        self.shared = ()
 
     def copy(self):
+        if self.variables:
+            self.shared = self.shared + (self.variables,)
+            self.variables = {}
+            if len(self.shared) > self.maxlevels:
+                self.shared = (self._collapse(),)
         new = VariableHistory(self.dataroot)
-        new.variables = self.variables.copy()
+        new.shared = self.shared
         return new
 
+    def _collapse(self):
+        merged = {}
+        for level in self.shared:
+            for var in level:
+                if var not in merged:
+                    merged[var] = self._events(var)
+        return merged
+
+    def _events(self, var):
+        """
+        Return the events recorded for var, a level starting with None
+        replaces the history of the levels below it.
+        """
+        chunks = []
+        for level in itertools.chain((self.variables,), reversed(self.shared)):
+            events = level.get(var)
+            if events is None:
+                continue
+            if events and events[0] is None:
+                chunks.append(events[1:])
+                break
+            chunks.append(events)
+        if len(chunks) == 1:
+            return list(chunks[0])
+        history = []
+        for events in reversed(chunks):
+            history.extend(events)
+        return history
+
     def record(self, *kwonly, **loginfo):
         if not self.dataroot._tracking:
             return
@@ -238,19 +429,14 @@ class VariableHistory(object):
             raise ValueError("record() missing variable or file.")
         var = loginfo['variable']
 
+        if 'nodups' in loginfo and loginfo in self.variable(var):
+            return
         if var not in self.variables:
             self.variables[var] = []
-        if not isinstance(self.variables[var], list):
-            return
-        if 'nodups' in loginfo and loginfo in self.variables[var]:
-            return
-        self.variables[var].append(loginfo.copy())
+        self.variables[var].append(VariableHistoryEvent(loginfo))
 
     def variable(self, var):
-        if var in self.variables:
-            return self.variables[var]
-        else:
-            return []
+        return [event.asdict(var) for event in self._events(var)]
 
     def emit(self, var, oval, val, o, d):
         history = self.variable(var)
@@ -339,11 +525,10 @@ class VariableHistory(object):
 
     def del_var_history(self, var, f=None, line=None):
         """If file f and line are not given, the entire history of var is deleted"""
-        if var in self.variables:
-            if f and line:
-                self.variables[var] = [ x for x in self.variables[var] if x['file']!=f and x['line']!=line]
-            else:
-                self.variables[var] = []
+        events = []
+        if f and line:
+            events = [x for x in self._events(var) if getattr(x, 'file', None) != f and getattr(x, 'line', None) != line]
+        self.variables[var] = [None] + events
 
 class DataSmart(MutableMapping):
     def __init__(self):
@@ -352,8 +537,9 @@ class DataSmart(MutableMapping):
         self.inchistory = IncludeHistory()
         self.varhistory = VariableHistory(self)
         self._tracking = False
+        self.frozen = False
 
-        self.expand_cache = {}
+        self.expand_cache = ExpansionCache()
 
         # cookie monster tribute
         # Need to be careful about writes to overridedata as
@@ -364,6 +550,12 @@ class DataSmart(MutableMapping):
         self.overridevars = set(["OVERRIDES", "FILE"])
         self.inoverride = False
 
+        # Resolved against the current overrides: the winning override
+        # variable for each variable in overridedata and whether each
+        # override string is active
+        self.overrideindex = {}
+        self.overridematch = {}
+
     def enableTracking(self):
         self._tracking = True
 
@@ -383,8 +575,9 @@ class DataSmart(MutableMapping):
         while s.find('${') != -1:
             olds = s
             try:
-                s = __expand_var_regexp__.sub(varparse.var_sub, s)
-                s = __expand_python_regexp__.sub(varparse.python_sub, s)
+                s = varparse.var_expand(s)
+                if "${@" in s:
+                    s = __expand_python_regexp__.sub(varparse.python_sub, s)
                 if s == olds:
                     break
             except ExpansionError:
@@ -398,7 +591,7 @@ class DataSmart(MutableMapping):
         varparse.value = s
 
         if varname:
-            self.expand_cache[varname] = varparse
+            self.expand_cache.add(varname, varparse)
 
         return varparse
 
@@ -411,6 +604,9 @@ class DataSmart(MutableMapping):
     def internal_finalize(self, parent = False):
         """Performs final steps upon the datastore, including application of overrides"""
         self.overrides = None
+        self.expand_cache.clear()
+        self.overrideindex = {}
+        self.overridematch = {}
 
     def need_overrides(self):
         if self.overrides is not None:
@@ -425,7 +621,9 @@ class DataSmart(MutableMapping):
             self.overrides = (self.getVar("OVERRIDES", True) or "").split(":") or []
             self.overridesset = set(self.overrides)
             self.inoverride = False
-            self.expand_cache = {}
+            self.expand_cache.clear()
+            self.overrideindex = {}
+            self.overridematch = {}
             newoverrides = (self.getVar("OVERRIDES", True) or "").split(":") or []
             if newoverrides == self.overrides:
                 break
@@ -434,8 +632,55 @@ class DataSmart(MutableMapping):
         else:
             bb.fatal("Overrides could not be expanded into a stable state after 5 iterations, overrides must be being referenced by other overridden variables in some recursive fashion. Please provide your configuration to bitbake-devel so we can laugh, er, I mean try and understand how to make it work.")
 
+    def _override_active(self, override):
+        """Return whether all the components of override are active"""
+        try:
+            return self.overridematch[override]
+        except KeyError:
+            active = set(override.split("_")).issubset(self.overridesset)
+            # The overrides are only placeholders while being computed
+            if not self.inoverride:
+                self.overridematch[override] = active
+            return active
+
+    def _override_winner(self, var):
+        """Return the override variable which supplies the value of var"""
+        try:
+            return self.overrideindex[var]
+        except KeyError:
+            pass
+        match = None
+        active = {}
+        for (r, o) in self.overridedata[var]:
+            # What about double overrides both with "_" in the name?
+            if o in self.overridesset or self._override_active(o):
+                active[o] = r
+
+        mod = True
+        while mod:
+            mod = False
+            for o in self.overrides:
+                for a in active.copy():
+                    if a.endswith("_" + o):
+                        t = active[a]
+                        del active[a]
+                        active[a.replace("_" + o, "")] = t
+                        mod = True
+                    elif a == o:
+                        match = active[a]
+                        del active[a]
+        if not self.inoverride:
+            self.overrideindex[var] = match
+        return match
+
+    def _expansion_changed(self, var):
+        # Anything could depend on the overrides
+        if var in self.overridevars:
+            self.expand_cache.clear()
+        else:
+            self.expand_cache.invalidate(var)
+
     def initVar(self, var):
-        self.expand_cache = {}
         if not var in self.dict:
             self.dict[var] = {}
 
@@ -463,13 +708,15 @@ class DataSmart(MutableMapping):
 
     def setVar(self, var, value, **loginfo):
         #print("var=" + str(var) + "  val=" + str(value))
+        if self.frozen:
+            raise FrozenError(var)
         parsing=False
         if 'parsing' in loginfo:
             parsing=True
 
         if 'op' not in loginfo:
             loginfo['op'] = "set"
-        self.expand_cache = {}
+        self._expansion_changed(var)
         match  = __setvar_regexp__.match(var)
         if match and match.group("keyword") in __setvar_keyword__:
             base = match.group('base')
@@ -509,14 +756,12 @@ class DataSmart(MutableMapping):
                 active = []
                 self.need_overrides()
                 for (r, o) in self.overridedata[var]:
-                    if o in self.overridesset:
+                    if o in self.overridesset or self._override_active(o):
                         active.append(r)
-                    elif "_" in o:
-                        if set(o.split("_")).issubset(self.overridesset):
-                            active.append(r)
                 for a in active:
                     self.delVar(a)
                 del self.overridedata[var]
+                self.overrideindex.pop(var, None)
 
         # more cookies for the cookie monster
         if '_' in var:
@@ -554,6 +799,7 @@ class DataSmart(MutableMapping):
                 # Force CoW by recreating the list first
                 self.overridedata[shortvar] = list(self.overridedata[shortvar])
                 self.overridedata[shortvar].append([var, override])
+                self.overrideindex.pop(shortvar, None)
             override = None
             if "_" in shortvar:
                 override = var[shortvar.rfind('_')+1:]
@@ -587,6 +833,7 @@ class DataSmart(MutableMapping):
 
         if key in self.overridedata:
             self.overridedata[newkey] = []
+            self.overrideindex.pop(newkey, None)
             for (v, o) in self.overridedata[key]:
                 self.overridedata[newkey].append([v.replace(key, newkey), o])
                 self.renameVar(v, v.replace(key, newkey))
@@ -611,13 +858,16 @@ class DataSmart(MutableMapping):
         self.setVar(var + "_prepend", value, ignore=True, parsing=True)
 
     def delVar(self, var, **loginfo):
+        if self.frozen:
+            raise FrozenError(var)
         loginfo['detail'] = ""
         loginfo['op'] = 'del'
         self.varhistory.record(**loginfo)
-        self.expand_cache = {}
+        self._expansion_changed(var)
         self.dict[var] = {}
         if var in self.overridedata:
             del self.overridedata[var]
+            self.overrideindex.pop(var, None)
         if '_' in var:
             override = var[var.rfind('_')+1:]
             shortvar = var[:var.rfind('_')]
@@ -627,6 +877,7 @@ class DataSmart(MutableMapping):
                         # Force CoW by recreating the list first
                         self.overridedata[shortvar] = list(self.overridedata[shortvar])
                         self.overridedata[shortvar].remove([var, override])
+                        self.overrideindex.pop(shortvar, None)
                 except ValueError as e:
                     pass
                 override = None
@@ -637,7 +888,9 @@ class DataSmart(MutableMapping):
                          override = None
 
     def setVarFlag(self, var, flag, value, **loginfo):
-        self.expand_cache = {}
+        if self.frozen:
+            raise FrozenError(var)
+        self._expansion_changed(var)
         if 'op' not in loginfo:
             loginfo['op'] = "set"
         loginfo['flag'] = flag
@@ -662,30 +915,8 @@ class DataSmart(MutableMapping):
         local_var = self._findVar(var)
         value = None
         if flag == "_content" and var in self.overridedata and not parsing:
-            match = False
-            active = {}
             self.need_overrides()
-            for (r, o) in self.overridedata[var]:
-                # What about double overrides both with "_" in the name?
-                if o in self.overridesset:
-                    active[o] = r
-                elif "_" in o:
-                    if set(o.split("_")).issubset(self.overridesset):
-                        active[o] = r
-
-            mod = True
-            while mod:
-                mod = False
-                for o in self.overrides:
-                    for a in active.copy():
-                        if a.endswith("_" + o):
-                            t = active[a]
-                            del active[a]
-                            active[a.replace("_" + o, "")] = t
-                            mod = True
-                        elif a == o:
-                            match = active[a]
-                            del active[a]
+            match = self._override_winner(var)
             if match:
                 value = self.getVar(match)
 
@@ -701,12 +932,7 @@ class DataSmart(MutableMapping):
                 value = ""
             self.need_overrides()
             for (r, o) in local_var["_append"]:
-                match = True
-                if o:
-                    for o2 in o.split("_"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
+                if not o or self._override_active(o):
                     value = value + r
 
         if flag == "_content" and local_var is not None and "_prepend" in local_var and not parsing:
@@ -714,13 +940,7 @@ class DataSmart(MutableMapping):
                 value = ""
             self.need_overrides()
             for (r, o) in local_var["_prepend"]:
-
-                match = True
-                if o:
-                    for o2 in o.split("_"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
+                if not o or self._override_active(o):
                     value = r + value
 
         if expand and value:
@@ -734,15 +954,15 @@ class DataSmart(MutableMapping):
 
         if value and flag == "_content" and local_var is not None and "_remove" in local_var:
             removes = []
+            refs = set()
+            volatile = False
             self.need_overrides()
             for (r, o) in local_var["_remove"]:
-                match = True
-                if o:
-                    for o2 in o.split("_"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
-                    removes.extend(self.expand(r).split())
+                if not o or self._override_active(o):
+                    varparse = self.expandWithRefs(r, None)
+                    removes.extend(varparse.value.split())
+                    refs |= varparse.references
+                    volatile = volatile or varparse.volatile
 
             filtered = filter(lambda v: v not in removes,
                               value.split())
@@ -751,10 +971,14 @@ class DataSmart(MutableMapping):
                  # We need to ensure the expand cache has the correct value
                  # flag == "_content" here
                 self.expand_cache[var].value = value
+                # and that it goes when anything the removals use changes
+                self.expand_cache.depends(var, refs, volatile)
         return value
 
     def delVarFlag(self, var, flag, **loginfo):
-        self.expand_cache = {}
+        if self.frozen:
+            raise FrozenError(var)
+        self._expansion_changed(var)
         local_var = self._findVar(var)
         if not local_var:
             return
@@ -784,7 +1008,9 @@ class DataSmart(MutableMapping):
         self.setVarFlag(var, flag, newvalue, ignore=True)
 
     def setVarFlags(self, var, flags, **loginfo):
-        self.expand_cache = {}
+        if self.frozen:
+            raise FrozenError(var)
+        self._expansion_changed(var)
         infer_caller_details(loginfo)
         if not var in self.dict:
             self._makeShadowCopy(var)
@@ -814,7 +1040,9 @@ class DataSmart(MutableMapping):
 
 
     def delVarFlags(self, var, **loginfo):
-        self.expand_cache = {}
+        if self.frozen:
+            raise FrozenError(var)
+        self._expansion_changed(var)
         if not var in self.dict:
             self._makeShadowCopy(var)
 
@@ -853,6 +1081,39 @@ class DataSmart(MutableMapping):
 
         return data
 
+    def flatten(self):
+        """
+        Collapse the chain of parent datastores this one was copied from
+        into a single snapshot, so looking a variable up no longer walks
+        the chain. The snapshot holds copies of the variables, changes made
+        to the parents afterwards are not seen.
+        """
+        parent = self.dict.get("_data")
+        if not parent:
+            return self
+
+        snapshot = {}
+        dest = parent
+        while dest:
+            for var in dest:
+                if var != "_data" and var not in snapshot:
+                    snapshot[var] = copy.copy(dest[var])
+            dest = dest.get("_data")
+        # Deleted variables only need to hide those further up the chain
+        for var in [var for var in snapshot if not snapshot[var]]:
+            del snapshot[var]
+        self.dict["_data"] = snapshot
+        return self
+
+    def freeze(self):
+        """
+        Flatten the datastore and refuse any further changes to it. Copies
+        made from it with createCopy() can still be changed.
+        """
+        self.flatten()
+        self.frozen = True
+        return self
+
     def expandVarref(self, variable, parents=False):
         """Find all references to variable in the data and expand it
            in place, optionally descending to parent datastores."""
@@ -899,11 +1160,8 @@ class DataSmart(MutableMapping):
         self.need_overrides()
         for var in self.overridedata:
             for (r, o) in self.overridedata[var]:
-                if o in self.overridesset:
+                if o in self.overridesset or self._override_active(o):
                     overrides.add(var)
-                elif "_" in o:
-                    if set(o.split("_")).issubset(self.overridesset):
-                        overrides.add(var)
 
         for k in keylist(self.dict):
              yield k
@@ -940,7 +1198,7 @@ class DataSmart(MutableMapping):
                 continue
 
             value = d.getVar(key, False) or ""
-            data.update({key:value})
+            data[key] = value
 
             varflags = d.getVarFlags(key, internalflags = True)
             if not varflags:
@@ -948,17 +1206,25 @@ class DataSmart(MutableMapping):
             for f in varflags:
                 if f == "_content":
                     continue
-                data.update({'%s[%s]' % (key, f):varflags[f]})
+                data['%s[%s]' % (key, f)] = varflags[f]
 
         for key in ["__BBTASKS", "__BBANONFUNCS", "__BBHANDLERS"]:
             bb_list = d.getVar(key, False) or []
             bb_list.sort()
-            data.update({key:str(bb_list)})
+            data[key] = str(bb_list)
 
             if key == "__BBANONFUNCS":
                 for i in bb_list:
                     value = d.getVar(i, True) or ""
-                    data.update({i:value})
-
-        data_str = str([(k, data[k]) for k in sorted(data.keys())])
-        return hashlib.md5(data_str).hexdigest()
+                    data[i] = value
+
+        # Feed the digest the same text as str() of the sorted item list
+        # would give, without building that string for the whole datastore
+        h = hashlib.md5()
+        sep = "["
+        for k in sorted(data):
+            h.update(sep)
+            h.update(repr((k, data[k])))
+            sep = ", "
+        h.update("]" if data else "[]")
+        return h.hexdigest()
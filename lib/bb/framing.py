@@ -0,0 +1,91 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake framing of the messages passed between the cooker, bitbake-worker
+# and the task processes
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import struct
+import cStringIO
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Every message starts with its name, padded with NULs, and the length of
+# the data which follows
+header = struct.Struct("!12sI")
+
+def frame(name, data = ""):
+    """
+    Return the message name with data, a string or buffer, framed to be
+    written to a pipe.
+    """
+    return header.pack(name, len(data)) + str(data)
+
+def load(data):
+    """
+    Unpickle the data of a message without copying it out of the buffer
+    """
+    return pickle.load(cStringIO.StringIO(data))
+
+class FrameBuffer(object):
+    """
+    Collects the data read from a pipe and splits it into messages. The
+    data is kept in a bytearray, consumed messages only move an offset
+    and the buffer is compacted once more than half of it is consumed.
+    """
+
+    # Don't bother compacting buffers smaller than this
+    compactsize = 65536
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.start = 0
+
+    def __len__(self):
+        return len(self.buf) - self.start
+
+    def __str__(self):
+        return str(self.buf[self.start:])
+
+    def feed(self, data):
+        """
+        Add data read from the pipe, this invalidates the data of any
+        messages returned previously.
+        """
+        if not data:
+            return
+        if self.start > self.compactsize and self.start * 2 > len(self.buf):
+            del self.buf[:self.start]
+            self.start = 0
+        self.buf.extend(data)
+
+    def frames(self):
+        """
+        Generate the (name, data) of each complete message in the buffer,
+        data is a buffer object which is only valid until the next feed().
+        """
+        while len(self.buf) - self.start >= header.size:
+            name, length = header.unpack_from(self.buf, self.start)
+            start = self.start + header.size
+            if len(self.buf) - start < length:
+                return
+            self.start = start + length
+            yield name.rstrip("\0"), buffer(self.buf, start, length)
+        if self.start == len(self.buf):
+            del self.buf[:]
+            self.start = 0
@@ -17,8 +17,91 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import hashlib
+import imp
+import marshal
+from bb.cache import MultiProcessCache
 from bb.utils import better_compile, better_exec
 
+class CodeCache(MultiProcessCache):
+    """
+    Code objects compiled by better_compile, keyed on a hash of the source
+    and the name it was compiled under. They are stored marshalled and only
+    loaded again when first used.
+    """
+    cache_file_name = "bb_code.dat"
+    # Marshalled code is only valid for the interpreter which wrote it
+    CACHE_VERSION = "1-" + imp.get_magic().encode("hex")
+
+    def __init__(self):
+        MultiProcessCache.__init__(self)
+        self.code = self.cachedata[0]
+        self.codeextras = self.cachedata_extras[0]
+        self.compiled = {}
+
+    def init_cache(self, d):
+        # Check if we already have the cache
+        if self.code:
+            return
+
+        MultiProcessCache.init_cache(self, d)
+
+        # cachedata gets re-assigned in the parent
+        self.code = self.cachedata[0]
+
+    def key(self, text, file, mode):
+        return hashlib.md5("\0".join([text, file, mode])).hexdigest()
+
+    def get(self, text, file, mode):
+        key = self.key(text, file, mode)
+        if key in self.compiled:
+            return self.compiled[key]
+        data = self.code.get(key) or self.codeextras.get(key)
+        if data is None:
+            return None
+        code = self.compiled[key] = marshal.loads(data)
+        return code
+
+    def add(self, text, file, mode, code):
+        key = self.key(text, file, mode)
+        self.compiled[key] = code
+        self.codeextras[key] = marshal.dumps(code)
+
+    def save_extras(self, d):
+        # Task processes in the worker save on exit, most have nothing new
+        if self.codeextras:
+            MultiProcessCache.save_extras(self, d)
+
+    def forked(self):
+        # The code compiled so far belongs to the parent process, keep it
+        # but only save what this process compiles itself
+        self.code.update(self.codeextras)
+        self.codeextras.clear()
+
+    def save_merge(self, d):
+        # Code compiled in this process, e.g. while parsing the
+        # configuration, is only held as extras
+        self.merge_data(self.cachedata_extras, self.cachedata)
+        MultiProcessCache.save_merge(self, d)
+
+codecache = CodeCache()
+
+def code_cache_init(d):
+    codecache.init_cache(d)
+
+def code_cache_save(d):
+    codecache.save_extras(d)
+
+def code_cache_savemerge(d):
+    codecache.save_merge(d)
+
+def code_cache_forked():
+    codecache.forked()
+
+# While the base configuration is parsed this collects the methods it
+# inserts, bitbake-worker replays them instead of parsing it again
+configmethods = None
+
 def insert_method(modulename, code, fn):
     """
     Add code of a module should be added. The methods
@@ -26,4 +109,6 @@ def insert_method(modulename, code, fn):
     """
     comp = better_compile(code, modulename, fn )
     better_exec(comp, None, code, fn)
+    if configmethods is not None:
+        configmethods.append((modulename, code, fn))
 
@@ -70,6 +70,49 @@ def cached_mtime_noerror(f):
             return 0
     return __mtime_cache[f]
 
+def prefetch_mtimes(files, num_threads):
+    """
+    Fill the mtime cache for files using a pool of num_threads threads and
+    return the set of files which don't exist. Files are grouped by
+    directory and a directory holding several of them is listed once, so
+    that only the files which exist need to be stat()ed.
+    """
+    bydir = {}
+    for f in set(files):
+        if f not in __mtime_cache:
+            bydir.setdefault(os.path.dirname(f), []).append(f)
+
+    def scan(item):
+        dirname, names = item
+        if len(names) > 1:
+            try:
+                entries = set(os.listdir(dirname or "."))
+            except OSError:
+                return [], names
+            missing = [f for f in names if os.path.basename(f) not in entries]
+            names = [f for f in names if os.path.basename(f) in entries]
+        else:
+            missing = []
+        found = []
+        for f in names:
+            try:
+                found.append((f, os.stat(f)[stat.ST_MTIME]))
+            except OSError:
+                missing.append(f)
+        return found, missing
+
+    import multiprocessing.pool
+    missing = set()
+    pool = multiprocessing.pool.ThreadPool(max(num_threads, 1))
+    try:
+        for found, notfound in pool.imap_unordered(scan, bydir.iteritems()):
+            __mtime_cache.update(found)
+            missing.update(notfound)
+    finally:
+        pool.close()
+        pool.join()
+    return missing
+
 def update_mtime(f):
     try:
         __mtime_cache[f] = os.stat(f)[stat.ST_MTIME]
@@ -23,12 +23,14 @@
 
 from __future__ import absolute_import
 from future_builtins import filter
+import os
 import re
 import string
 import logging
 import bb
 import itertools
 from bb import methodpool
+from bb.cache import MultiProcessCache
 from bb.parse import logger
 
 _bbversions_re = re.compile(r"\[(?P<from>[0-9]+)-(?P<to>[0-9]+)\]")
@@ -178,10 +180,11 @@ class PythonMethodNode(AstNode):
         data.setVar(self.function, text, parsing=True)
 
 class MethodFlagsNode(AstNode):
-    def __init__(self, filename, lineno, key, m):
+    def __init__(self, filename, lineno, key, python, fakeroot):
         AstNode.__init__(self, filename, lineno)
         self.key = key
-        self.m = m
+        self.python = python
+        self.fakeroot = fakeroot
 
     def eval(self, data):
         if data.getVar(self.key, False):
@@ -189,11 +192,11 @@ class MethodFlagsNode(AstNode):
             # flags could cause problems
             data.setVarFlag(self.key, 'python', None)
             data.setVarFlag(self.key, 'fakeroot', None)
-        if self.m.group("py") is not None:
+        if self.python:
             data.setVarFlag(self.key, "python", "1")
         else:
             data.delVarFlag(self.key, "python")
-        if self.m.group("fr") is not None:
+        if self.fakeroot:
             data.setVarFlag(self.key, "fakeroot", "1")
         else:
             data.delVarFlag(self.key, "fakeroot")
@@ -269,6 +272,86 @@ class InheritNode(AstNode):
     def eval(self, data):
         bb.parse.BBHandler.inherit(self.classes, self.filename, self.lineno, data)
 
+class StatementCache(MultiProcessCache):
+    """
+    Statement groups of parsed files, keyed on a hash of the file contents
+    and whatever else the parse depends on, so an unchanged file doesn't
+    need to be tokenized again. Only the latest statements of each file
+    are kept, those of its earlier contents are dropped when the cache is
+    written out, as are those of files which no longer exist.
+    """
+    cache_file_name = "bb_ast.dat"
+    CACHE_VERSION = 2
+
+    def __init__(self):
+        MultiProcessCache.__init__(self)
+        self.statements = self.cachedata[0]
+        self.statementsextras = self.cachedata_extras[0]
+        self.files = self.cachedata[1]
+        self.filesextras = self.cachedata_extras[1]
+
+    def init_cache(self, d):
+        # Check if we already have the cache
+        if self.statements:
+            return
+
+        MultiProcessCache.init_cache(self, d)
+
+        # cachedata gets re-assigned in the parent
+        self.statements = self.cachedata[0]
+        self.files = self.cachedata[1]
+
+    def create_cachedata(self):
+        # The statements by key and the key of the latest statements of
+        # each file, as (absolute filename, names it was parsed under)
+        data = [{}, {}]
+        return data
+
+    def get(self, key, fileid):
+        statements = self.statements.get(key)
+        if statements is None:
+            statements = self.statementsextras.get(key)
+        if statements is not None and self.files.get(fileid) != key:
+            self.filesextras[fileid] = key
+        return statements
+
+    def add(self, key, statements, fileid):
+        self.statementsextras[key] = statements
+        self.filesextras[fileid] = key
+
+    def merge_data(self, source, dest):
+        for key in source[0]:
+            if key not in dest[0]:
+                dest[0][key] = source[0][key]
+        dest[1].update(source[1])
+        self.prune(dest)
+
+    @staticmethod
+    def prune(data):
+        latest = set(data[1].itervalues())
+        for key in [key for key in data[0] if key not in latest]:
+            del data[0][key]
+
+    def save_merge(self, d):
+        # Files parsed in this process before the cache was written out,
+        # the configuration files for example, are only held as extras
+        self.merge_data(self.cachedata_extras, self.cachedata)
+        for fileid in [fileid for fileid in self.files if not os.path.exists(fileid[0])]:
+            del self.files[fileid]
+        self.prune(self.cachedata)
+        MultiProcessCache.save_merge(self, d)
+
+statementcache = StatementCache()
+
+def statement_cache_init(d):
+    statementcache.init_cache(d)
+
+def statement_cache_save(d):
+    statementcache.save_extras(d)
+
+def statement_cache_savemerge(d):
+    statementcache.save_merge(d)
+
 def handleInclude(statements, filename, lineno, m, force):
     statements.append(IncludeNode(filename, lineno, m.group(1), force))
 
@@ -285,7 +368,7 @@ def handlePythonMethod(statements, filename, lineno, funcname, modulename, body)
     statements.append(PythonMethodNode(filename, lineno, funcname, modulename, body))
 
 def handleMethodFlags(statements, filename, lineno, key, m):
-    statements.append(MethodFlagsNode(filename, lineno, key, m))
+    statements.append(MethodFlagsNode(filename, lineno, key, m.group("py") is not None, m.group("fr") is not None))
 
 def handleExportFuncs(statements, filename, lineno, m, classname):
     statements.append(ExportFuncsNode(filename, lineno, m.group(1), classname))
@@ -383,6 +466,12 @@ def multi_finalize(fn, d):
 
     onlyfinalise = d.getVar("__ONLYFINALISE", False)
 
+    # The anonymous functions and the signature generator look up most
+    # variables, don't walk the chain of configuration copies. The recipe
+    # level itself stays live as BBCLASSEXTEND and __VARIANTS are set on
+    # it after the variants are finalised.
+    d.flatten()
+
     safe_d = d
     d = bb.data.createCopy(safe_d)
     try:
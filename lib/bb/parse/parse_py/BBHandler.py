@@ -27,7 +27,9 @@
 
 from __future__ import absolute_import
 import re, bb, os
+import hashlib
 import logging
+from cStringIO import StringIO
 import bb.build, bb.utils
 from bb import data
 
@@ -54,6 +56,8 @@ __body__   = []
 __classname__ = ""
 
 cached_statements = {}
+# The (mtime, size) of the files when their statements were cached
+cached_statements_stat = {}
 
 # We need to indicate EOF to the feeder. This code is so messy that
 # factoring it out to a close_parse_file method is out of question.
@@ -97,25 +101,83 @@ def get_statements(filename, absolute_filename, base_name):
     try:
         return cached_statements[absolute_filename]
     except KeyError:
-        file = open(absolute_filename, 'r')
-        statements = ast.StatementGroup()
-
-        lineno = 0
-        while True:
-            lineno = lineno + 1
-            s = file.readline()
-            if not s: break
-            s = s.rstrip()
-            feeder(lineno, s, filename, base_name, statements)
-        file.close()
-        if __inpython__:
-            # add a blank line to close out any python definition
-            feeder(IN_PYTHON_EOF, "", filename, base_name, statements)
+        with open(absolute_filename, 'r') as f:
+            content = f.read()
+            st = os.fstat(f.fileno())
+
+        # The statements only depend on the contents and the names the
+        # file is parsed under, so an unchanged file can reuse them
+        key = hashlib.md5("\0".join([content, filename, base_name, __classname__])).hexdigest()
+        fileid = (absolute_filename, filename, base_name, __classname__)
+        statements = ast.statementcache.get(key, fileid)
+        if statements is None:
+            file = StringIO(content)
+            statements = ast.StatementGroup()
+
+            lineno = 0
+            while True:
+                lineno = lineno + 1
+                s = file.readline()
+                if not s: break
+                s = s.rstrip()
+                feeder(lineno, s, filename, base_name, statements)
+            if __inpython__:
+                # add a blank line to close out any python definition
+                feeder(IN_PYTHON_EOF, "", filename, base_name, statements)
+
+            # Incomplete files raise an error in handle(), don't keep them
+            if not __infunc__ and not __residue__:
+                ast.statementcache.add(key, statements, fileid)
 
         if filename.endswith(".bbclass") or filename.endswith(".inc"):
             cached_statements[absolute_filename] = statements
+            cached_statements_stat[absolute_filename] = (st.st_mtime, st.st_size)
         return statements
 
+def preload_statements(bbpath):
+    """
+    Parse every class found under bbpath into the statement cache. Parser
+    processes forked afterwards then start with the classes already
+    parsed rather than each parsing them again.
+    """
+    global __infunc__, __body__, __residue__, __classname__, __inpython__
+    # Files may have changed since their statements were cached, which
+    # a memory resident server isn't always told about
+    for abs_fn in list(cached_statements):
+        try:
+            st = os.stat(abs_fn)
+            current = (st.st_mtime, st.st_size)
+        except OSError:
+            current = None
+        if current != cached_statements_stat.get(abs_fn):
+            del cached_statements[abs_fn]
+            cached_statements_stat.pop(abs_fn, None)
+
+    for path in bbpath.split(":"):
+        classdir = os.path.join(path, "classes")
+        if not path or not os.path.isdir(classdir):
+            continue
+        for name in sorted(os.listdir(classdir)):
+            abs_fn = os.path.join(classdir, name)
+            if not name.endswith(".bbclass") or abs_fn in cached_statements:
+                continue
+            __body__ = []
+            __infunc__ = []
+            __residue__ = []
+            __inpython__ = False
+            __classname__ = os.path.splitext(name)[0]
+            try:
+                get_statements(abs_fn, abs_fn, name)
+            except Exception as exc:
+                # Any problem will be reported when a recipe inherits it
+                logger.debug(1, "Unable to preload %s: %s" % (abs_fn, exc))
+                cached_statements.pop(abs_fn, None)
+    __body__ = []
+    __infunc__ = []
+    __residue__ = []
+    __inpython__ = False
+    __classname__ = ""
+
 def handle(fn, d, include):
     global __func_start_regexp__, __inherit_regexp__, __export_func_regexp__, __addtask_regexp__, __addhandler_regexp__, __infunc__, __body__, __residue__, __classname__
     __body__ = []
@@ -25,8 +25,10 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import errno
+import hashlib
 import re
 import os
+from cStringIO import StringIO
 import bb.utils
 from bb.parse import ParseError, resolve_file, ast, logger, handle
 
@@ -122,11 +124,33 @@ def handle(fn, data, include):
         oldfile = data.getVar('FILE', False)
 
     abs_fn = resolve_file(fn, data)
-    f = open(abs_fn, 'r')
+    with open(abs_fn, 'r') as f:
+        content = f.read()
 
     if include:
         bb.parse.mark_dependency(data, abs_fn)
 
+    statements = get_statements(fn, abs_fn, content)
+
+    # DONE WITH PARSING... time to evaluate
+    data.setVar('FILE', abs_fn)
+    statements.eval(data)
+    if oldfile:
+        data.setVar('FILE', oldfile)
+
+    for f in confFilters:
+        f(fn, data)
+
+    return data
+
+def get_statements(fn, abs_fn, content):
+    key = hashlib.md5("\0".join([content, abs_fn])).hexdigest()
+    fileid = (abs_fn,)
+    statements = ast.statementcache.get(key, fileid)
+    if statements is not None:
+        return statements
+
+    f = StringIO(content)
     statements = ast.StatementGroup()
     lineno = 0
     while True:
@@ -150,18 +174,8 @@ def handle(fn, data, include):
             continue
         feeder(lineno, s, abs_fn, statements)
 
-    # DONE WITH PARSING... time to evaluate
-    data.setVar('FILE', abs_fn)
-    statements.eval(data)
-    if oldfile:
-        data.setVar('FILE', oldfile)
-
-    f.close()
-
-    for f in confFilters:
-        f(fn, data)
-
-    return data
+    ast.statementcache.add(key, statements, fileid)
+    return statements
 
 def feeder(lineno, s, fn, statements):
     m = __config_regexp__.match(s)
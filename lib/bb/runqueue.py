@@ -23,10 +23,12 @@ Handles preparation and execution of a queue of tasks
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import copy
+import heapq
 import os
 import sys
 import signal
 import stat
+import time
 import fcntl
 import errno
 import logging
@@ -34,6 +36,8 @@ import re
 import bb
 from bb import msg, data, event
 from bb import monitordisk
+import bb.framing
+import bb.persist_data
 import subprocess
 
 try:
@@ -117,34 +121,46 @@ class RunQueueScheduler(object):
 
         self.rev_prio_map = None
 
-    def next_buildable_task(self):
+    def prepare_buildable(self):
         """
-        Return the id of the first task we find that is buildable
+        Turn the buildable tasks into a heap ordered by priority, this
+        happens on first use as subclasses set up the priority map after
+        calling our constructor.
         """
-        self.buildable = [x for x in self.buildable if not self.rq.runq_running[x] == 1]
-        if not self.buildable:
-            return None
-        if len(self.buildable) == 1:
-            taskid = self.buildable[0]
-            stamp = self.stamps[taskid]
-            if stamp not in self.rq.build_stamps.itervalues():
-                return taskid
-
-        if not self.rev_prio_map:
-            self.rev_prio_map = range(self.numTasks)
-            for taskid in xrange(self.numTasks):
-                self.rev_prio_map[self.prio_map[taskid]] = taskid
+        self.rev_prio_map = range(self.numTasks)
+        for taskid in xrange(self.numTasks):
+            self.rev_prio_map[self.prio_map[taskid]] = taskid
+        self.buildable = [(self.rev_prio_map[taskid], taskid) for taskid in self.buildable]
+        heapq.heapify(self.buildable)
 
+    def next_buildable_task(self):
+        """
+        Return the id of the buildable task with the best priority whose
+        stamp isn't in use by a running task and which the resources in use
+        allow to start
+        """
+        if self.rev_prio_map is None:
+            self.prepare_buildable()
+
+        # Tasks which started running are only removed once they reach
+        # the top of the heap, the task we return stays on it until then
+        buildable = self.buildable
+        running = self.rq.runq_running
+        build_stamps = self.rq.build_stamps2
+        resources = self.rq.resources
+        blocked = []
         best = None
-        bestprio = None
-        for taskid in self.buildable:
-            prio = self.rev_prio_map[taskid]
-            if bestprio is None or bestprio > prio:
-                stamp = self.stamps[taskid]
-                if stamp in self.rq.build_stamps.itervalues():
-                    continue
-                bestprio = prio
+        while buildable:
+            taskid = buildable[0][1]
+            if running[taskid] == 1:
+                heapq.heappop(buildable)
+            elif self.stamps[taskid] in build_stamps or (resources and not resources.admit(taskid)):
+                blocked.append(heapq.heappop(buildable))
+            else:
                 best = taskid
+                break
+        for entry in blocked:
+            heapq.heappush(buildable, entry)
 
         return best
 
@@ -156,7 +172,10 @@ class RunQueueScheduler(object):
             return self.next_buildable_task()
 
     def newbuilable(self, task):
-        self.buildable.append(task)
+        if self.rev_prio_map is None:
+            self.buildable.append(task)
+        else:
+            heapq.heappush(self.buildable, (self.rev_prio_map[task], task))
 
 class RunQueueSchedulerSpeed(RunQueueScheduler):
     """
@@ -171,15 +190,9 @@ class RunQueueSchedulerSpeed(RunQueueScheduler):
         """
         RunQueueScheduler.__init__(self, runqueue, rqdata)
 
-        sortweight = sorted(copy.deepcopy(self.rqdata.runq_weight))
-        copyweight = copy.deepcopy(self.rqdata.runq_weight)
-        self.prio_map = []
-
-        for weight in sortweight:
-            idx = copyweight.index(weight)
-            self.prio_map.append(idx)
-            copyweight[idx] = -1
-
+        # The sort is stable, so once reversed tasks of the same weight
+        # are ordered by decreasing task number
+        self.prio_map = sorted(xrange(self.numTasks), key=self.rqdata.runq_weight.__getitem__)
         self.prio_map.reverse()
 
 class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
@@ -198,21 +211,256 @@ class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
         #FIXME - whilst this groups all fnids together it does not reorder the
         #fnid groups optimally.
 
-        basemap = copy.deepcopy(self.prio_map)
-        self.prio_map = []
-        while (len(basemap) > 0):
-            entry = basemap.pop(0)
-            self.prio_map.append(entry)
+        # Each fnid's tasks keep their order and the groups are ordered by
+        # the first task of each fnid in the speed map
+        groups = {}
+        order = []
+        for entry in self.prio_map:
             fnid = self.rqdata.runq_fnid[entry]
-            todel = []
-            for entry in basemap:
-                entry_fnid = self.rqdata.runq_fnid[entry]
-                if entry_fnid == fnid:
-                    todel.append(basemap.index(entry))
-                    self.prio_map.append(entry)
-            todel.reverse()
-            for idx in todel:
-                del basemap[idx]
+            if fnid not in groups:
+                groups[fnid] = []
+                order.append(fnid)
+            groups[fnid].append(entry)
+        self.prio_map = []
+        for fnid in order:
+            self.prio_map.extend(groups[fnid])
+
+class RunQueueSchedulerCriticalPath(RunQueueSchedulerSpeed):
+    """
+    A scheduler optimised for wall clock time on many core machines. Using
+    the durations of the tasks in previous builds, each task is ranked by
+    the longest chain of work from it to the end of the build (its critical
+    path) and the task with the longest critical path is run first. Ties
+    fall back to the speed scheduler's order.
+    """
+    name = "criticalpath"
+
+    def __init__(self, runqueue, rqdata):
+        RunQueueSchedulerSpeed.__init__(self, runqueue, rqdata)
+
+        duration = self.task_durations()
+
+        # Walk from the endpoints back to the tasks they depend on so
+        # each task is only reached once all its reverse dependencies are
+        critical = [0.0] * self.numTasks
+        deps_left = [len(revdeps) for revdeps in self.rqdata.runq_revdeps]
+        endpoints = [task for task in xrange(self.numTasks) if not deps_left[task]]
+        while endpoints:
+            next_points = []
+            for task in endpoints:
+                revdeps = self.rqdata.runq_revdeps[task]
+                critical[task] = duration[task] + max([critical[revdep] for revdep in revdeps] or [0.0])
+                for dep in self.rqdata.runq_depends[task]:
+                    deps_left[dep] = deps_left[dep] - 1
+                    if deps_left[dep] == 0:
+                        next_points.append(dep)
+            endpoints = next_points
+        self.critical = critical
+
+        speedrank = [0] * self.numTasks
+        for rank, task in enumerate(self.prio_map):
+            speedrank[task] = rank
+        self.prio_map = sorted(xrange(self.numTasks), key=lambda task: (-critical[task], speedrank[task]))
+
+    def task_durations(self):
+        """
+        Return the expected duration of each task. Tasks without history
+        use the average of the same task in other recipes, or of all the
+        tasks if that isn't known either. Tasks covered by setscene tasks
+        won't run so they take no time.
+        """
+        history = {}
+        if self.rq.task_durations:
+            history = self.rq.task_durations.load()
+
+        bytask = {}
+        for key, value in history.iteritems():
+            bytask.setdefault(key.rsplit(":", 1)[-1], []).append(value)
+        average = {}
+        for taskname, values in bytask.iteritems():
+            average[taskname] = sum(values) / len(values)
+        if history:
+            default = sum(history.itervalues()) / len(history)
+        else:
+            default = 1.0
+
+        covered = self.rq.rq.scenequeue_covered
+        duration = []
+        for task in xrange(self.numTasks):
+            if task in covered:
+                duration.append(0.0)
+                continue
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+            taskname = self.rqdata.runq_task[task]
+            key = TaskDurations.key(self.rqdata.dataCache.pkg_fn[fn], taskname)
+            if key in history:
+                duration.append(history[key])
+            else:
+                duration.append(average.get(taskname, default))
+        return duration
+
+class TaskDurations(object):
+    """
+    The time tasks took to run in previous builds, keyed by PN and task
+    name and kept in the persistent data store. Nothing is kept when
+    neither PERSISTENT_DIR nor CACHE are set.
+    """
+
+    # Weight of the latest run in the recorded duration
+    smoothing = 0.5
+
+    def __init__(self, d):
+        self.table = None
+        self.durations = None
+        if d.getVar("PERSISTENT_DIR", True) or d.getVar("CACHE", True):
+            self.table = bb.persist_data.persist("BB_TASK_DURATIONS", d)
+
+    def __nonzero__(self):
+        return self.table is not None
+
+    @staticmethod
+    def key(pn, taskname):
+        return "%s:%s" % (pn, taskname)
+
+    def load(self):
+        """
+        Return a dict of the recorded durations in seconds
+        """
+        if self.durations is None:
+            self.durations = {}
+            if self.table is not None:
+                for key, value in self.table.iteritems():
+                    try:
+                        self.durations[key] = float(value)
+                    except ValueError:
+                        pass
+        return self.durations
+
+    def record(self, pn, taskname, duration):
+        if self.table is None:
+            return
+        key = self.key(pn, taskname)
+        previous = self.load().get(key)
+        if previous is not None:
+            duration = previous + (duration - previous) * self.smoothing
+        self.durations[key] = duration
+        self.table[key] = str(duration)
+
+class RunQueueResources(object):
+    """
+    Admission of tasks against per-resource budgets and the load of the
+    machine. Tasks declare what they use with the "resources" varflag, a
+    list of resource names with optional weights, e.g.
+    do_compile[resources] = "cpu memory=2". BB_RESOURCE_LIMITS sets the
+    budget of each resource, e.g. "memory=8 network=4", and the weights of
+    the running tasks using a resource may not exceed its budget. Tasks
+    using "cpu" aren't started while the load average is above
+    BB_RESOURCE_MAX_LOADAVG, tasks using "memory" aren't started while
+    less than BB_RESOURCE_MIN_FREE_MEMORY MiB of memory is available.
+    A task is always admitted when nothing else is running.
+    """
+
+    # Seconds between readings of /proc
+    interval = 1.0
+
+    def __init__(self, rqdata, d):
+        self.rqdata = rqdata
+        self.limits = self.parse(d.getVar("BB_RESOURCE_LIMITS", True))
+        self.maxload = float(d.getVar("BB_RESOURCE_MAX_LOADAVG", True) or 0)
+        self.minmemory = int(d.getVar("BB_RESOURCE_MIN_FREE_MEMORY", True) or 0) * 1024 * 1024
+        self.enabled = bool(self.limits or self.maxload or self.minmemory)
+        self.inuse = {}
+        self.running = {}
+        self.demands = {}
+        self.readtime = None
+        self.loadavg = None
+        self.memory = None
+
+    def __nonzero__(self):
+        return self.enabled
+
+    @staticmethod
+    def parse(value):
+        """
+        Return a dict of the weights in "name=weight name ..." where the
+        weight defaults to 1
+        """
+        resources = {}
+        for item in (value or "").split():
+            name, _, weight = item.partition("=")
+            try:
+                resources[name] = float(weight or 1)
+            except ValueError:
+                bb.warn("Invalid weight '%s' for resource %s" % (weight, name))
+        return resources
+
+    def demand(self, task):
+        if task not in self.demands:
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+            taskname = self.rqdata.runq_task[task]
+            taskdep = self.rqdata.dataCache.task_deps[fn]
+            self.demands[task] = self.parse(taskdep.get('resources', {}).get(taskname))
+        return self.demands[task]
+
+    def read_proc(self):
+        """
+        Refresh the load average and the available memory, both are None
+        when they can't be read
+        """
+        now = time.time()
+        if self.readtime is not None and now - self.readtime < self.interval:
+            return
+        self.readtime = now
+        try:
+            with open("/proc/loadavg") as f:
+                self.loadavg = float(f.read().split()[0])
+        except (IOError, ValueError, IndexError):
+            self.loadavg = None
+        try:
+            meminfo = {}
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    fields = line.split()
+                    meminfo[fields[0].rstrip(":")] = int(fields[1]) * 1024
+            if "MemAvailable" in meminfo:
+                self.memory = meminfo["MemAvailable"]
+            else:
+                self.memory = meminfo["MemFree"] + meminfo.get("Buffers", 0) + meminfo.get("Cached", 0)
+        except (IOError, ValueError, IndexError, KeyError):
+            self.memory = None
+
+    def admit(self, task):
+        """
+        Return whether task can start with the resources currently in use
+        """
+        if not self.running:
+            return True
+        demand = self.demand(task)
+        if not demand:
+            return True
+        for name, weight in demand.iteritems():
+            inuse = self.inuse.get(name, 0)
+            if name in self.limits and inuse and inuse + weight > self.limits[name]:
+                return False
+        if ("cpu" in demand and self.maxload) or ("memory" in demand and self.minmemory):
+            self.read_proc()
+            if "cpu" in demand and self.maxload and self.loadavg is not None and self.loadavg > self.maxload:
+                return False
+            if "memory" in demand and self.minmemory and self.memory is not None and self.memory < self.minmemory:
+                return False
+        return True
+
+    def start(self, task):
+        demand = self.demand(task)
+        self.running[task] = demand
+        for name, weight in demand.iteritems():
+            self.inuse[name] = self.inuse.get(name, 0) + weight
+
+    def finish(self, task):
+        demand = self.running.pop(task, None)
+        if demand:
+            for name, weight in demand.iteritems():
+                self.inuse[name] = self.inuse[name] - weight
 
 class RunQueueData:
     """
@@ -902,8 +1150,11 @@ class RunQueue:
             "time" : self.cfgData.getVar("TIME", True),
         }
 
-        worker.stdin.write("<cookerconfig>" + pickle.dumps(self.cooker.configuration) + "</cookerconfig>")
-        worker.stdin.write("<workerdata>" + pickle.dumps(workerdata) + "</workerdata>")
+        worker.stdin.write(bb.framing.frame("cookerconfig", pickle.dumps(self.cooker.configuration)))
+        configdata = self.cooker.databuilder.workerConfiguration()
+        if configdata:
+            worker.stdin.write(bb.framing.frame("configdata", configdata))
+        worker.stdin.write(bb.framing.frame("workerdata", pickle.dumps(workerdata)))
         worker.stdin.flush()
 
         return worker, workerpipe
@@ -913,7 +1164,7 @@ class RunQueue:
             return
         logger.debug(1, "Teardown for bitbake-worker")
         try:
-           worker.stdin.write("<quit></quit>")
+           worker.stdin.write(bb.framing.frame("quit"))
            worker.stdin.flush()
         except IOError:
            pass
@@ -1282,7 +1533,12 @@ class RunQueueExecute:
         self.runq_complete = []
 
         self.build_stamps = {}
-        self.build_stamps2 = []
+        self.task_starttimes = {}
+        self.task_durations = None
+        self.resources = None
+        # The stamps of the running tasks, to avoid starting a task whose
+        # stamp is already in use
+        self.build_stamps2 = set()
         self.failed_fnids = []
 
         self.stampcache = {}
@@ -1298,12 +1554,20 @@ class RunQueueExecute:
 
         # self.build_stamps[pid] may not exist when use shared work directory.
         if task in self.build_stamps:
-            self.build_stamps2.remove(self.build_stamps[task])
+            self.build_stamps2.discard(self.build_stamps[task])
             del self.build_stamps[task]
 
+        starttime = self.task_starttimes.pop(task, None)
+        if self.resources:
+            self.resources.finish(task)
         if status != 0:
             self.task_fail(task, status)
         else:
+            if starttime is not None and self.task_durations:
+                fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+                self.task_durations.record(self.rqdata.dataCache.pkg_fn[fn],
+                                           self.rqdata.runq_task[task],
+                                           time.time() - starttime)
             self.task_complete(task)
         return True
 
@@ -1313,7 +1577,7 @@ class RunQueueExecute:
             if not worker:
                 continue
             try:
-                worker.stdin.write("<finishnow></finishnow>")
+                worker.stdin.write(bb.framing.frame("finishnow"))
                 worker.stdin.flush()
             except IOError:
                 # worker must have died?
@@ -1459,6 +1723,10 @@ class RunQueueExecuteTasks(RunQueueExecute):
 
         event.fire(bb.event.StampUpdate(self.rqdata.target_pairs, self.rqdata.dataCache.stamp), self.cfgData)
 
+        # The schedulers can rank the tasks by how long they took before
+        self.task_durations = TaskDurations(self.cfgData)
+        self.resources = RunQueueResources(self.rqdata, self.cfgData)
+
         schedulers = self.get_schedulers()
         for scheduler in schedulers:
             if self.scheduler == scheduler.name:
@@ -1597,14 +1865,18 @@ class RunQueueExecuteTasks(RunQueueExecute):
                         logger.critical("Failed to spawn fakeroot worker to run %s:%s: %s" % (fn, taskname, str(exc)))
                         self.rq.state = runQueueFailed
                         return True
-                self.rq.fakeworker.stdin.write("<runtask>" + pickle.dumps((fn, task, taskname, False, self.cooker.collection.get_file_appends(fn), taskdepdata)) + "</runtask>")
+                self.rq.fakeworker.stdin.write(bb.framing.frame("runtask", pickle.dumps((fn, task, taskname, False, self.cooker.collection.get_file_appends(fn), taskdepdata))))
                 self.rq.fakeworker.stdin.flush()
             else:
-                self.rq.worker.stdin.write("<runtask>" + pickle.dumps((fn, task, taskname, False, self.cooker.collection.get_file_appends(fn), taskdepdata)) + "</runtask>")
+                self.rq.worker.stdin.write(bb.framing.frame("runtask", pickle.dumps((fn, task, taskname, False, self.cooker.collection.get_file_appends(fn), taskdepdata))))
                 self.rq.worker.stdin.flush()
 
             self.build_stamps[task] = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
-            self.build_stamps2.append(self.build_stamps[task]) 
+            self.build_stamps2.add(self.build_stamps[task])
+            if not self.cooker.configuration.dry_run:
+                self.task_starttimes[task] = time.time()
+            if self.resources:
+                self.resources.start(task)
             self.runq_running[task] = 1
             self.stats.taskActive()
             if self.stats.active < self.number_tasks:
@@ -1988,10 +2260,10 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
             if 'fakeroot' in taskdep and taskname in taskdep['fakeroot']:
                 if not self.rq.fakeworker:
                     self.rq.start_fakeworker(self)
-                self.rq.fakeworker.stdin.write("<runtask>" + pickle.dumps((fn, realtask, taskname, True, self.cooker.collection.get_file_appends(fn), None)) + "</runtask>")
+                self.rq.fakeworker.stdin.write(bb.framing.frame("runtask", pickle.dumps((fn, realtask, taskname, True, self.cooker.collection.get_file_appends(fn), None))))
                 self.rq.fakeworker.stdin.flush()
             else:
-                self.rq.worker.stdin.write("<runtask>" + pickle.dumps((fn, realtask, taskname, True, self.cooker.collection.get_file_appends(fn), None)) + "</runtask>")
+                self.rq.worker.stdin.write(bb.framing.frame("runtask", pickle.dumps((fn, realtask, taskname, True, self.cooker.collection.get_file_appends(fn), None))))
                 self.rq.worker.stdin.flush()
 
             self.runq_running[task] = 1
@@ -2142,7 +2414,7 @@ class runQueuePipe():
         if pipeout:
             pipeout.close()
         bb.utils.nonblockingfd(self.input)
-        self.queue = ""
+        self.queue = bb.framing.FrameBuffer()
         self.d = d
         self.rq = rq
         self.rqexec = rqexec
@@ -2166,39 +2438,31 @@ class runQueuePipe():
 
         start = len(self.queue)
         try:
-            self.queue = self.queue + self.input.read(102400)
+            self.queue.feed(self.input.read(102400))
         except (OSError, IOError) as e:
             if e.errno != errno.EAGAIN:
                 raise
         end = len(self.queue)
-        found = True
-        while found and len(self.queue):
-            found = False
-            index = self.queue.find("</event>")
-            while index != -1 and self.queue.startswith("<event>"):
+        for name, payload in self.queue.frames():
+            if name == "event":
                 try:
-                    event = pickle.loads(self.queue[7:index])
+                    event = bb.framing.load(payload)
                 except ValueError as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[7:index]))
+                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, str(payload)))
                 bb.event.fire_from_worker(event, self.d)
-                found = True
-                self.queue = self.queue[index+8:]
-                index = self.queue.find("</event>")
-            index = self.queue.find("</exitcode>")
-            while index != -1 and self.queue.startswith("<exitcode>"):
+            elif name == "exitcode":
                 try:
-                    task, status = pickle.loads(self.queue[10:index])
+                    task, status = bb.framing.load(payload)
                 except ValueError as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[10:index]))
+                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, str(payload)))
                 self.rqexec.runqueue_process_waitpid(task, status)
-                found = True
-                self.queue = self.queue[index+11:]
-                index = self.queue.find("</exitcode>")
+            else:
+                bb.msg.fatal("RunQueue", "unknown message '%s' from the worker" % name)
         return (end > start)
 
     def close(self):
         while self.read():
             continue
         if len(self.queue) > 0:
-            print("Warning, worker left partial message: %s" % self.queue)
+            print("Warning, worker left partial message: %s" % str(self.queue))
         self.input.close()
@@ -0,0 +1,327 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the recipe cache (cache.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import os
+import pickle
+import tempfile
+import bb
+import bb.cache
+import bb.cooker
+import bb.parse
+import bb.siggen
+
+class IndexedCacheFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "bb_cache.dat.hash")
+
+    def tearDown(self):
+        bb.utils.remove(self.tempdir, True)
+
+    def write(self, records):
+        bb.cache.write_cachefile(self.filename,
+                                 ((key, pickle.dumps(value, -1)) for key, value in records))
+
+    def reopen(self):
+        cachefile = bb.cache.IndexedCacheFile(self.filename)
+        self.assertEqual(cachefile.open(), (bb.cache.__cache_version__, bb.__version__))
+        self.addCleanup(cachefile.close)
+        return cachefile
+
+    def test_roundtrip(self):
+        self.write([("a", 1), ("b", [2, "two"])])
+        cachefile = self.reopen()
+        self.assertEqual(sorted(cachefile.keys()), ["a", "b"])
+        self.assertIn("b", cachefile)
+        self.assertNotIn("c", cachefile)
+        self.assertEqual(cachefile.load("a"), 1)
+        self.assertEqual(cachefile.load("b"), [2, "two"])
+        self.assertEqual(pickle.loads(cachefile.raw("b")), [2, "two"])
+        self.assertEqual(os.listdir(self.tempdir), ["bb_cache.dat.hash"])
+
+    def test_append(self):
+        self.write([("a", 1), ("b", 2), ("c", 3)])
+        cachefile = self.reopen()
+        size = os.path.getsize(self.filename)
+        records = [(key, pickle.dumps(value, -1)) for key, value in [("a", 10), ("d", 4)]]
+        self.assertTrue(bb.cache.append_cachefile(cachefile, records, set(["b"]), 1.0))
+        self.assertGreater(os.path.getsize(self.filename), size)
+
+        cachefile = self.reopen()
+        self.assertEqual(sorted(cachefile.keys()), ["a", "c", "d"])
+        self.assertEqual([cachefile.load(key) for key in ["a", "c", "d"]], [10, 3, 4])
+
+        # The mapping of the old file no longer matches it
+        stale = bb.cache.IndexedCacheFile(self.filename)
+        stale.open()
+        self.assertTrue(bb.cache.append_cachefile(cachefile, [], set(), 1.0))
+        self.assertFalse(bb.cache.append_cachefile(stale, [], set(), 1.0))
+        stale.close()
+
+    def test_compact(self):
+        self.write([("a", "x" * 1000), ("b", "y")])
+        cachefile = self.reopen()
+        size = os.path.getsize(self.filename)
+        # Replacing most of the contents leaves too many dead bytes behind
+        records = [("a", pickle.dumps("z", -1))]
+        self.assertFalse(bb.cache.append_cachefile(cachefile, records, set(), 0.5))
+        self.assertEqual(os.path.getsize(self.filename), size)
+        self.assertEqual(cachefile.load("a"), "x" * 1000)
+
+        self.write([("a", "z"), ("b", "y")])
+        cachefile = self.reopen()
+        self.assertLess(os.path.getsize(self.filename), size)
+        self.assertEqual(cachefile.load("a"), "z")
+
+    def test_invalid(self):
+        for contents in ["", "BBCACHE1", "NOTCACHE" + "\0" * 16]:
+            with open(self.filename, "wb") as f:
+                f.write(contents)
+            cachefile = bb.cache.IndexedCacheFile(self.filename)
+            self.assertRaises(ValueError, cachefile.open)
+            cachefile.close()
+
+        # An index past the end of the file
+        self.write([("a", 1)])
+        with open(self.filename, "r+b") as f:
+            f.truncate(os.path.getsize(self.filename) - 1)
+        cachefile = bb.cache.IndexedCacheFile(self.filename)
+        self.assertRaises(ValueError, cachefile.open)
+        cachefile.close()
+
+    def test_version(self):
+        # Caches written by another version are rebuilt
+        oldversion = bb.cache.__cache_version__
+        bb.cache.__cache_version__ = "0"
+        try:
+            self.write([("a", 1)])
+        finally:
+            bb.cache.__cache_version__ = oldversion
+        cachefile = bb.cache.IndexedCacheFile(self.filename)
+        self.assertEqual(cachefile.open(), ("0", bb.__version__))
+        cachefile.close()
+
+        d = bb.data.init()
+        d.setVar("CACHE", self.tempdir)
+        cache = bb.cache.Cache(d, "hash", [bb.cache.CoreRecipeInfo])
+        self.assertEqual(len(cache.depends_cache), 0)
+        self.assertNotIn("a", cache.depends_cache)
+
+        self.write([("a", 1)])
+        cache = bb.cache.Cache(d, "hash", [bb.cache.CoreRecipeInfo])
+        self.assertIn("a", cache.depends_cache)
+        cache.depends_cache.close()
+
+class CacheTest(unittest.TestCase):
+    recipe = """
+PV = "%s"
+do_build() {
+    :
+}
+addtask build
+"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("CACHE", os.path.join(self.tempdir, "cache"))
+        bb.parse.siggen = bb.siggen.init(self.d)
+        self.caches_array = [bb.cache.CoreRecipeInfo]
+        self.cachefile = os.path.join(self.tempdir, "cache", "bb_cache.dat.hash")
+
+    def tearDown(self):
+        bb.utils.remove(self.tempdir, True)
+
+    def write_recipe(self, name, pv="1.0"):
+        fn = os.path.join(self.tempdir, "%s.bb" % name)
+        exists = os.path.exists(fn)
+        with open(fn, "w") as f:
+            f.write(self.recipe % pv)
+        if exists:
+            # Make sure the change is seen whatever the mtime granularity
+            mtime = os.stat(fn).st_mtime + 10
+            os.utime(fn, (mtime, mtime))
+            bb.parse.update_cache(fn)
+        return fn
+
+    def newcache(self):
+        cache = bb.cache.Cache(self.d, "hash", self.caches_array)
+        self.addCleanup(cache.depends_cache.close)
+        return cache
+
+    def parse(self, cache, fns):
+        cachedata = bb.cache.CacheData(self.caches_array)
+        for fn in fns:
+            for virtualfn, info_array in cache.parse(fn, [], self.d, self.caches_array):
+                cache.add_info(virtualfn, info_array, cachedata, parsed=True)
+
+    def test_sync_append(self):
+        fns = [self.write_recipe("r%s" % i) for i in range(3)]
+        cache = self.newcache()
+        self.parse(cache, fns)
+        cache.sync()
+        inode = os.stat(self.cachefile).st_ino
+        size = os.path.getsize(self.cachefile)
+
+        fns[1] = self.write_recipe("r1", "2.0")
+        cache = self.newcache()
+        self.assertEqual([cache.cacheValid(fn, []) for fn in fns], [True, False, True])
+        self.parse(cache, [fns[1]])
+        cache.sync()
+        # Only the changed entry was added to the file
+        self.assertEqual(os.stat(self.cachefile).st_ino, inode)
+        self.assertGreater(os.path.getsize(self.cachefile), size)
+
+        cache = self.newcache()
+        self.assertEqual([cache.cacheValid(fn, []) for fn in fns], [True, True, True])
+        self.assertEqual([cache.depends_cache[fn][0].pv for fn in fns], ["1.0", "2.0", "1.0"])
+
+    def test_sync_compact(self):
+        fns = [self.write_recipe("r%s" % i) for i in range(3)]
+        cache = self.newcache()
+        self.parse(cache, fns)
+        cache.sync()
+        inode = os.stat(self.cachefile).st_ino
+
+        # Once too much of the file is stale it is written out again
+        self.d.setVar("BB_CACHE_COMPACT_RATIO", "0")
+        fns[0] = self.write_recipe("r0", "2.0")
+        cache = self.newcache()
+        self.assertFalse(cache.cacheValid(fns[0], []))
+        self.parse(cache, [fns[0]])
+        cache.sync()
+        self.assertNotEqual(os.stat(self.cachefile).st_ino, inode)
+
+        cache = self.newcache()
+        self.assertEqual([cache.cacheValid(fn, []) for fn in fns], [True, True, True])
+        self.assertEqual(cache.depends_cache[fns[0]][0].pv, "2.0")
+
+    def test_valid_many(self):
+        # Enough recipes for the entries to be checked in two processes
+        fns = [self.write_recipe("r%s" % i) for i in range(100)]
+        cache = self.newcache()
+        self.parse(cache, fns)
+        cache.sync()
+
+        self.write_recipe("r3", "2.0")
+        self.write_recipe("r50", "2.0")
+        os.unlink(fns[70])
+        bb.parse.update_cache(fns[70])
+        fns.append(self.write_recipe("r100"))
+        invalid = set([fns[3], fns[50], fns[70], fns[100]])
+        items = [(fn, []) for fn in fns]
+
+        for num_processes in (2, 1):
+            cache = self.newcache()
+            cache.cacheValidMany(items, num_processes)
+            self.assertEqual(cache.checked, set(fns))
+            self.assertEqual(cache.clean, set(fns) - invalid)
+            for fn in invalid:
+                self.assertNotIn(fn, cache.depends_cache)
+                self.assertFalse(cache.cacheValid(fn, []))
+
+    def test_valid_unmodified(self):
+        fns = [self.write_recipe("r%s" % i) for i in range(2)]
+        cache = self.newcache()
+        self.parse(cache, fns)
+        cache.sync()
+
+        # Recipes inotify reported no changes for aren't stat()ed, only
+        # their appends are compared
+        self.write_recipe("r0", "2.0")
+        cache = self.newcache()
+        self.assertTrue(cache.cacheValidUnmodified(fns[0], []))
+        self.assertFalse(cache.cacheValidUnmodified(fns[1], ["r1.bbappend"]))
+        self.assertEqual(cache.clean, set([fns[0]]))
+        self.assertNotIn(fns[1], cache.depends_cache)
+        self.assertFalse(cache.cacheValidUnmodified(fns[0] + ".missing", []))
+
+    def test_recipes_affected_by(self):
+        class Cooker(object):
+            recipes_affected_by = bb.cooker.BBCooker.recipes_affected_by.__func__
+        cooker = Cooker()
+        cooker.depends_index = {
+            "/recipes/a.bb" : set(["/recipes/a.bb"]),
+            "/recipes/b.bb" : set(["/recipes/b.bb"]),
+            "/recipes/inc/common.inc" : set(["/recipes/a.bb", "/recipes/b.bb"]),
+            "/classes/c.bbclass" : set(["/recipes/b.bb"]),
+        }
+        self.assertEqual(cooker.recipes_affected_by("/recipes/a.bb"), set(["/recipes/a.bb"]))
+        self.assertEqual(cooker.recipes_affected_by("/recipes/inc/common.inc"),
+                         set(["/recipes/a.bb", "/recipes/b.bb"]))
+        # A directory which was created or removed affects everything below it
+        self.assertEqual(cooker.recipes_affected_by("/classes"), set(["/recipes/b.bb"]))
+        self.assertEqual(cooker.recipes_affected_by("/recipes/inc"),
+                         set(["/recipes/a.bb", "/recipes/b.bb"]))
+        self.assertEqual(cooker.recipes_affected_by("/recipes/inc/other.inc"), set())
+        self.assertEqual(cooker.recipes_affected_by("/recipe"), set())
+
+    def test_valid_unmodified_checksums(self):
+        # The files listed in the file checksums aren't watched so their
+        # presence is still checked
+        present = os.path.join(self.tempdir, "present")
+        missing = os.path.join(self.tempdir, "missing")
+        open(present, "w").close()
+        fn = self.write_recipe("r0")
+        with open(fn, "a") as f:
+            f.write('do_build[file-checksums] = "%s:True %s:False"\n' % (present, missing))
+        cache = self.newcache()
+        self.parse(cache, [fn])
+        cache.sync()
+
+        cache = self.newcache()
+        self.assertTrue(cache.cacheValidUnmodified(fn, []))
+        open(missing, "w").close()
+        cache = self.newcache()
+        self.assertFalse(cache.cacheValidUnmodified(fn, []))
+        self.assertNotIn(fn, cache.depends_cache)
+
+    def test_skipped_unwatched(self):
+        fns = [self.write_recipe("r%s" % i) for i in range(2)]
+        with open(fns[1], "a") as f:
+            f.write('python () {\n    raise bb.parse.SkipRecipe("skipped")\n}\n')
+        cache = self.newcache()
+
+        class Cooker(object):
+            def __init__(self):
+                self.depends_index = {}
+                self.skiplist = {}
+                self.watched = set()
+            def add_filewatch(self, deps):
+                self.watched.update(f for f, _ in deps)
+        class Parser(object):
+            parse_next = bb.cooker.CookerParser.parse_next.__func__
+        parser = Parser()
+        parser.cooker = Cooker()
+        parser.cooker.recipecache = bb.cache.CacheData(self.caches_array)
+        parser.bb_cache = cache
+        parser.results = iter([(True, cache.parse(fn, [], self.d, self.caches_array)) for fn in fns])
+        parser.current = parser.virtuals = parser.parsed = parser.cached = parser.skipped = 0
+        parser.progress_chunk = 100
+        parser.unwatched = set()
+        self.assertTrue(parser.parse_next())
+        self.assertTrue(parser.parse_next())
+
+        # Changes to the files of a skipped recipe wouldn't be reported by
+        # inotify, so it can't be treated as unmodified
+        self.assertEqual(parser.skipped, 1)
+        self.assertIn(fns[0], parser.cooker.watched)
+        self.assertNotIn(fns[1], parser.cooker.watched)
+        self.assertEqual(parser.unwatched, set([fns[1]]))
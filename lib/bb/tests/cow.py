@@ -21,6 +21,7 @@
 
 import unittest
 import os
+import time
 
 class COWTestCase(unittest.TestCase):
     """
@@ -134,3 +135,96 @@ class COWTestCase(unittest.TestCase):
         self.assertEquals(1028, copy['123'])
         self.assertEquals(4712, copy['other'])
         self.assertEquals({'abc':20, 'bcd':20}, copy['d'])
+
+    def testSnapshot(self):
+        from bb.COW import COWDictBase
+        a = COWDictBase.copy()
+        a['a'] = 1
+        a['l'] = [1]
+        b = a.copy()
+
+        # Changes after the copy are not visible on the other side
+        a['b'] = 2
+        a['l'].append(2)
+        b['l'].append(3)
+        self.assertEquals(False, b.has_key('b'))
+        self.assertEquals([1, 2], a['l'])
+        self.assertEquals([1, 3], b['l'])
+
+        del b['a']
+        self.assertEquals(False, b.has_key('a'))
+        self.assertEquals(1, a['a'])
+        b.__revertitem__('a')
+        self.assertEquals(1, b['a'])
+        self.assertEquals(['a', 'l'], list(b.iterkeys()))
+
+    def testCollisions(self):
+        from bb.COW import COWDictBase
+
+        class Key(object):
+            def __init__(self, name):
+                self.name = name
+            def __hash__(self):
+                return 42
+            def __eq__(self, other):
+                return self.name == other.name
+
+        keys = [Key(i) for i in range(5)]
+        a = COWDictBase.copy()
+        for i, key in enumerate(keys):
+            a[key] = i
+        b = a.copy()
+        del b[keys[2]]
+        self.assertEquals(range(5), [a[key] for key in keys])
+        self.assertEquals(False, b.has_key(keys[2]))
+        self.assertEquals(3, b[keys[3]])
+        self.assertEquals(4, len(b))
+
+    def testSet(self):
+        from bb.COW import COWSetBase
+        a = COWSetBase.copy()
+        a.add("o1")
+        a.add("o1")
+        a.add("o2")
+        b = a.copy()
+        b.remove("o1")
+        self.assertEquals(["o1", "o2"], list(a.itervalues()))
+        self.assertEquals(["o2"], list(b.itervalues()))
+        self.assertRaises(TypeError, b.iterkeys)
+
+class COWBenchmark(unittest.TestCase):
+    """
+    Lookup and copy costs of the COW dictionaries at increasing copy
+    depths, which should stay flat
+    """
+
+    if os.environ.get("BB_RUN_BENCHMARKS") != "yes":
+        print("Set BB_RUN_BENCHMARKS=yes to run benchmarks")
+    else:
+        def testDepth(self):
+            from bb.COW import COWDictBase
+
+            def measure(depth):
+                c = COWDictBase.copy()
+                for i in range(1000):
+                    c["key%d" % i] = i
+                for i in range(depth):
+                    c = c.copy()
+                    c["level%d" % i] = i
+                start = time.time()
+                for i in range(100):
+                    # A fresh copy has not looked up anything yet
+                    l = c.copy()
+                    for j in range(0, 1000, 10):
+                        l["key%d" % j]
+                lookup = time.time() - start
+                start = time.time()
+                for i in range(10000):
+                    c.copy()
+                return lookup, time.time() - start
+
+            results = {}
+            for depth in (1, 10, 50, 100):
+                results[depth] = measure(depth)
+                print("\ndepth %3d: 10000 lookups %.4fs, 10000 copies %.4fs" % ((depth,) + results[depth]))
+            self.assertLess(results[100][0], results[1][0] * 3)
@@ -93,6 +93,16 @@ class DataExpansions(unittest.TestCase):
         self.d.setVar("BAR", "bar value ${@int('test')}")
         self.assertRaises(bb.data_smart.ExpansionError, self.d.getVar, "FOO", True)
 
+    def test_python_snippet_shared(self):
+        self.d.setVar("FOO", "${@d.getVar('foo', True)} ${bar}")
+        d2 = bb.data.init()
+        d2.setVar("foo", "other_foo")
+        d2.setVar("FOO", "${@d.getVar('foo', True)} ${bar}")
+        self.assertEqual(self.d.getVar("FOO", True), "value_of_foo value_of_bar")
+        self.assertEqual(d2.getVar("FOO", True), "other_foo ${bar}")
+        refs = d2.expandWithRefs(d2.getVar("FOO", False), "FOO").references
+        self.assertEqual(refs, set(["foo", "bar"]))
+
     def test_value_containing_value(self):
         val = self.d.expand("${@d.getVar('foo', True) + ' ${bar}'}")
         self.assertEqual(str(val), "value_of_foo value_of_bar")
@@ -219,6 +229,56 @@ class TestMemoize(unittest.TestCase):
         self.assertEqual(d.getVar("foo", False),
                          d.getVar("bar", False))
 
+    def test_expand_cache_unrelated(self):
+        d = bb.data.init()
+        d.setVar("FOO", "${BAR} foo")
+        d.setVar("BAR", "bar")
+        self.assertEqual(d.getVar("FOO", True), "bar foo")
+        d.setVar("OTHER", "other")
+        self.assertTrue("FOO" in d.expand_cache)
+        self.assertEqual(d.getVar("FOO", True), "bar foo")
+
+    def test_expand_cache_dependent(self):
+        d = bb.data.init()
+        d.setVar("FOO", "${BAR} foo")
+        d.setVar("BAR", "${BAZ}")
+        d.setVar("BAZ", "baz")
+        d.setVarFlag("FOO", "doc", "${BAZ}")
+        self.assertEqual(d.getVar("FOO", True), "baz foo")
+        self.assertEqual(d.getVarFlag("FOO", "doc", True), "baz")
+        d.setVar("BAZ_append", " more")
+        self.assertEqual(d.getVar("FOO", True), "baz more foo")
+        self.assertEqual(d.getVarFlag("FOO", "doc", True), "baz more")
+        d.setVarFlag("FOO", "doc", "doc")
+        self.assertEqual(d.getVarFlag("FOO", "doc", True), "doc")
+
+    def test_expand_cache_python(self):
+        d = bb.data.init()
+        d.setVar("FOO", "${@d.getVar('BAR' + 'X', True)}")
+        d.setVar("BARX", "1")
+        self.assertEqual(d.getVar("FOO", True), "1")
+        d.setVar("BARX", "2")
+        self.assertEqual(d.getVar("FOO", True), "2")
+
+    def test_expand_cache_remove(self):
+        d = bb.data.init()
+        d.setVar("OVERRIDES", "bar")
+        d.setVar("FOO_remove", "${BAR} ${BAZ}")
+        d.setVar("FOO", "x y z")
+        self.assertEqual(d.getVar("FOO", True), "x y z")
+        d.setVar("BAR", "x y z")
+        self.assertEqual(d.getVar("FOO", True), "")
+        d.setVar("BAR", "q")
+        self.assertEqual(d.getVar("FOO", True), "x y z")
+        d.setVar("BAZ_bar", " y")
+        self.assertEqual(d.getVar("FOO", True), "x z")
+
+        d.setVar("FOO2_remove", "${@d.getVar('BAR' + '2', True)}")
+        d.setVar("FOO2", "x y z")
+        self.assertEqual(d.getVar("FOO2", True), "x y z")
+        d.setVar("BAR2", "y")
+        self.assertEqual(d.getVar("FOO2", True), "x z")
+
 class TestConcat(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -372,6 +432,20 @@ class TestOverrides(unittest.TestCase):
         self.d.setVar("OVERRIDES", "foo:bar:some_val")
         self.assertEqual(self.d.getVar("TEST", True), "testvalue3")
 
+    def test_override_index_updates(self):
+        self.d.setVar("TEST_bar", "testvalue2")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue2")
+        self.d.setVar("TEST_local", "testvalue3")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue3")
+        self.d.delVar("TEST_local")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue2")
+        self.d.setVar("OVERRIDES", "foo:local")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue")
+        self.d.setVar("TEST_append_foo", " appended")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue appended")
+        self.d.setVar("OVERRIDES", "local")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue")
+
 class TestKeyExpansion(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -403,6 +477,105 @@ class TestFlags(unittest.TestCase):
         self.assertEqual(self.d.getVarFlag("foo", "flag2"), None)
 
 
+class TestFlatten(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "foo")
+        self.d.setVar("BAR", "bar")
+        self.d.setVarFlag("BAR", "flag", "flag")
+        copy1 = bb.data.createCopy(self.d)
+        copy1.setVar("FOO", "foo2")
+        copy1.delVar("BAR")
+        copy1.setVar("BAZ", "${FOO}")
+        self.copy = bb.data.createCopy(copy1)
+
+    def test_flatten(self):
+        self.copy.setVar("LOCAL", "local")
+        self.copy.flatten()
+        self.assertNotIn("_data", self.copy.dict["_data"])
+        self.assertEqual(self.copy.getVar("BAZ", True), "foo2")
+        self.assertEqual(self.copy.getVar("BAR", False), None)
+        self.assertItemsEqual(self.copy.keys(), ["FOO", "BAZ", "LOCAL"])
+        self.copy.setVarFlag("FOO", "flag", "set")
+        self.assertEqual(self.d.getVarFlag("FOO", "flag"), None)
+
+    def test_flatten_parent_changes(self):
+        self.copy.flatten()
+        # Whether the parent changes a variable in place or replaces it
+        self.d.setVarFlag("BAR", "flag", "changed")
+        self.d.setVar("FOO", "changed")
+        self.d.setVar("NEW", "new")
+        self.assertEqual(self.copy.getVar("FOO", False), "foo2")
+        self.assertEqual(self.copy.getVar("NEW", False), None)
+        frozen = bb.data.createCopy(self.d).freeze()
+        self.d.setVar("BAR", "changed")
+        self.d.setVarFlag("FOO", "flag", "changed")
+        self.assertEqual(frozen.getVar("BAR", False), "bar")
+        self.assertEqual(frozen.getVarFlag("BAR", "flag", False), "changed")
+        self.assertEqual(frozen.getVarFlag("FOO", "flag", False), None)
+
+    def test_freeze(self):
+        frozen = self.copy.freeze()
+        self.assertEqual(frozen.getVar("BAZ", True), "foo2")
+        self.assertRaises(bb.data_smart.FrozenError, frozen.setVar, "FOO", "changed")
+        self.assertRaises(bb.data_smart.FrozenError, frozen.delVarFlag, "FOO", "flag")
+        child = bb.data.createCopy(frozen)
+        child.setVar("FOO", "changed")
+        self.assertEqual(child.getVar("BAZ", True), "changed")
+        self.assertEqual(frozen.getVar("FOO", True), "foo2")
+
+class TestHash(unittest.TestCase):
+    def test_hash(self):
+        d1 = bb.data.init()
+        d2 = bb.data.init()
+        for d in (d1, d2):
+            d.setVar("FOO", "${BAR} foo")
+            d.setVarFlag("FOO", "doc", "documentation")
+            d.setVar("BB_HASHCONFIG_WHITELIST", "DATE")
+        d1.setVar("BAR", "bar")
+        d2.setVar("BAR", "bar")
+        d2.setVar("DATE", "today")
+        self.assertEqual(d1.get_hash(), d2.get_hash())
+        d2.setVarFlag("FOO", "doc", "changed")
+        self.assertNotEqual(d1.get_hash(), d2.get_hash())
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.enableTracking()
+        self.d.setVar("FOO", "foo", file="a.conf", line=1)
+        self.d.setVarFlag("FOO", "doc", "docs", file="a.conf", line=2)
+
+    def history(self, d, var):
+        return [(e['op'], e['file'], e['line'], e.get('flag')) for e in d.varhistory.variable(var)]
+
+    def test_record(self):
+        self.assertEqual(self.history(self.d, "FOO"), [("set", "a.conf", 1, None), ("set", "a.conf", 2, "doc")])
+        self.assertEqual(self.d.varhistory.variable("FOO")[0]['detail'], "foo")
+        self.assertEqual(self.d.varhistory.get_variable_files("FOO"), ["a.conf", "a.conf"])
+
+    def test_copy(self):
+        child = bb.data.createCopy(self.d)
+        child.appendVar("FOO", " bar", file="b.bb", line=3)
+        self.d.setVar("FOO", "baz", file="a.conf", line=4)
+        self.assertEqual(self.history(child, "FOO")[1:], [("set", "a.conf", 2, "doc"), ("append", "b.bb", 3, None)])
+        self.assertEqual(self.history(self.d, "FOO")[1:], [("set", "a.conf", 2, "doc"), ("set", "a.conf", 4, None)])
+
+    def test_del_history(self):
+        child = bb.data.createCopy(self.d)
+        child.varhistory.del_var_history("FOO")
+        child.setVar("FOO", "bar", file="b.bb", line=5)
+        self.assertEqual(self.history(child, "FOO"), [("set", "b.bb", 5, None)])
+        self.assertEqual(len(self.history(self.d, "FOO")), 2)
+
+    def test_levels(self):
+        d = self.d
+        for i in range(d.varhistory.maxlevels * 2):
+            d.setVar("FOO", str(i), file="b.bb", line=i)
+            d = bb.data.createCopy(d)
+        self.assertEqual(len(self.history(d, "FOO")), d.varhistory.maxlevels * 2 + 2)
+        self.assertTrue(len(d.varhistory.shared) <= d.varhistory.maxlevels)
+
 class Contains(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -24,12 +24,15 @@ import tempfile
 import logging
 import bb
 import os
+import pickle
 
 logger = logging.getLogger('BitBake.TestParse')
 
 import bb.parse
 import bb.data
 import bb.siggen
+import bb.cache
+import bb.cookerdata
 
 class ParseTest(unittest.TestCase):
 
@@ -145,3 +148,252 @@ python () {
         self.assertEqual(d1.getVar("VAR_var", True), "B")
         self.assertEqual(d2.getVar("VAR_var", True), None)
 
+
+    def test_prefetch_mtimes(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            present = [os.path.join(tempdir, "present%s" % i) for i in range(3)]
+            for f in present:
+                open(f, "w").close()
+            missing = [os.path.join(tempdir, "missing"), os.path.join(tempdir, "nodir", "missing")]
+            notfound = bb.parse.prefetch_mtimes(present + missing + present, 2)
+            self.assertEqual(notfound, set(missing))
+            for f in present:
+                self.assertEqual(bb.parse.cached_mtime_noerror(f), int(os.stat(f).st_mtime))
+        finally:
+            bb.utils.remove(tempdir, True)
+
+    def test_preload_statements(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tempdir, "classes"))
+            clsname = os.path.join(tempdir, "classes", "preloaded.bbclass")
+            with open(clsname, "w") as f:
+                f.write(self.classextend_bbclass)
+            bb.parse.BBHandler.preload_statements(tempdir)
+            self.assertIn(clsname, bb.parse.BBHandler.cached_statements)
+            f = self.parsehelper('inherit preloaded\nVAR_var = "A"\n')
+            self.d.setVar("BBPATH", tempdir)
+            d = bb.parse.handle(f.name, self.d.createCopy())['']
+            self.assertEqual(d.getVar("VAR_var2", True), "A")
+
+            # A changed class is parsed again by the next preload
+            with open(clsname, "w") as f:
+                f.write(self.classextend_bbclass.replace("VAR_var2", "VAR_var3"))
+            mtime = os.stat(clsname).st_mtime
+            os.utime(clsname, (mtime + 10, mtime + 10))
+            bb.parse.BBHandler.preload_statements(tempdir)
+            f = self.parsehelper('inherit preloaded\nVAR_var = "A"\n')
+            d = bb.parse.handle(f.name, self.d.createCopy())['']
+            self.assertEqual(d.getVar("VAR_var3", True), "A")
+        finally:
+            bb.parse.BBHandler.cached_statements.pop(clsname, None)
+            bb.parse.BBHandler.cached_statements_stat.pop(clsname, None)
+            bb.utils.remove(tempdir, True)
+
+    def test_statement_cache(self):
+        f = self.parsehelper(self.testfile + "python do_compile() {\n    pass\n}\n")
+        d = bb.parse.handle(f.name, self.d)['']
+        self.assertEqual(d.getVarFlag("do_compile", "python"), "1")
+
+        # Unchanged files come back from the cache without being tokenized
+        feeder = bb.parse.BBHandler.feeder
+        def nofeeder(*args):
+            self.fail("Cached statements were parsed again")
+        bb.parse.BBHandler.feeder = nofeeder
+        try:
+            d = bb.parse.handle(f.name, bb.data.init())['']
+        finally:
+            bb.parse.BBHandler.feeder = feeder
+        self.assertEqual(d.getVar("C", True), "3")
+        self.assertEqual(d.getVarFlag("do_compile", "python"), "1")
+
+        # and the cache has to survive being written out
+        statements = bb.parse.BBHandler.get_statements(f.name, f.name, os.path.basename(f.name))
+        statements = pickle.loads(pickle.dumps(statements, -1))
+        d = bb.data.init()
+        statements.eval(d)
+        self.assertEqual(d.getVar("A", True), "1")
+        self.assertEqual(d.getVarFlag("do_compile", "python"), "1")
+
+    def test_statement_cache_prune(self):
+        f = self.parsehelper(self.testfile)
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.d.setVar("PERSISTENT_DIR", tempdir)
+            def reload():
+                cache = bb.parse.ast.StatementCache()
+                cache.init_cache(self.d)
+                return cache
+
+            cache = reload()
+            cache.add("old", bb.parse.ast.StatementGroup(), (f.name,))
+            cache.add("gone", bb.parse.ast.StatementGroup(), ("/nonexistent.bb",))
+            cache.save_merge(self.d)
+            cache = reload()
+            # Only the latest statements of an existing file are kept
+            self.assertEqual(sorted(cache.statements), ["old"])
+
+            cache.add("new", bb.parse.ast.StatementGroup(), (f.name,))
+            cache.save_merge(self.d)
+            cache = reload()
+            self.assertEqual(sorted(cache.statements), ["new"])
+            self.assertIsNotNone(cache.get("new", (f.name,)))
+            self.assertIsNone(cache.get("old", (f.name,)))
+        finally:
+            bb.utils.remove(tempdir, True)
+
+    def test_recipe_data_cache(self):
+        f = self.parsehelper(self.testfile)
+        cache = bb.cache.RecipeDataCache(1024 * 1024)
+        d1 = cache.loadDataFull(f.name, [], self.d)
+        self.assertIs(cache.loadDataFull(f.name, [], self.d), d1)
+        self.assertTrue(0 < cache.size <= cache.budget)
+        self.assertEqual(self.d.getVar("__ONLYFINALISE", False), None)
+
+        # Changing the recipe means it has to be parsed again
+        f.seek(0)
+        f.write(self.testfile.replace('"1"', '"4"'))
+        f.flush()
+        mtime = os.stat(f.name).st_mtime
+        os.utime(f.name, (mtime + 10, mtime + 10))
+        d2 = cache.loadDataFull(f.name, [], self.d)
+        self.assertIsNot(d2, d1)
+        self.assertEqual(d2.getVar("A", True), "4")
+        self.assertEqual(len(cache.entries), 1)
+
+        # Nothing is kept once the budget is exceeded
+        cache = bb.cache.RecipeDataCache(0)
+        d3 = cache.loadDataFull(f.name, [], self.d)
+        self.assertEqual(d3.getVar("A", True), "4")
+        self.assertIsNot(cache.loadDataFull(f.name, [], self.d), d3)
+        self.assertEqual(cache.size, 0)
+
+    def test_recipe_data_cache_siggen(self):
+        self.d.setVar("BB_SIGNATURE_HANDLER", "basic")
+        bb.parse.siggen = bb.siggen.init(self.d)
+        siggen = bb.parse.siggen
+        fs = [self.parsehelper(self.testfile + "export B\naddtask install\n") for i in range(3)]
+        cache = bb.cache.RecipeDataCache(1024 * 1024)
+        cache.loadDataFull(fs[0].name, [], self.d)
+        cache.loadDataFull(fs[1].name, [], self.d)
+        self.assertIn(fs[0].name, siggen.taskdeps)
+        self.assertIn(fs[0].name + ".do_install", siggen.basehash)
+
+        # The signature data of evicted datastores is dropped with them
+        cache.budget = cache.size - 1
+        cache.loadDataFull(fs[2].name, [], self.d)
+        self.assertNotIn((fs[0].name, ()), cache.entries)
+        for fn in [f.name for f in fs]:
+            held = (fn, ()) in cache.entries
+            self.assertEqual(fn in siggen.taskdeps, held)
+            self.assertEqual(fn in siggen.gendeps, held)
+            self.assertEqual(fn in siggen.lookupcache, held)
+            self.assertEqual(fn + ".do_install" in siggen.basehash, held)
+
+        # as is that of datastores which aren't kept at all
+        cache = bb.cache.RecipeDataCache(0)
+        cache.loadDataFull(fs[0].name, [], self.d)
+        self.assertNotIn(fs[0].name, siggen.taskdeps)
+        self.assertNotIn(fs[0].name + ".do_install", siggen.basehash)
+
+    recipedatafile = """
+A = "1"
+def recipe_data_value(d):
+    return d.getVar("A", True)
+addhandler recipe_data_handler
+python recipe_data_handler() {
+}
+"""
+
+    def test_recipe_data_cache_state(self):
+        f = self.parsehelper(self.recipedatafile)
+        g = self.parsehelper(self.testfile)
+        context = dict(bb.utils.get_context())
+        handlers = bb.event.get_class_handlers().copy()
+        try:
+            cache = bb.cache.RecipeDataCache(1024 * 1024)
+            # Missed recipes are only parsed when asked to
+            self.assertEqual(cache.get(f.name, []), None)
+            self.assertEqual(cache.get(g.name, []), None)
+            self.assertTrue(cache.fill(self.d))
+            self.assertTrue(cache.fill(self.d))
+            self.assertFalse(cache.fill(self.d))
+            self.assertEqual(len(cache.entries), 2)
+
+            # Each datastore comes with the functions and handlers of its
+            # own parse
+            d1 = cache.get(f.name, [])
+            self.assertEqual(bb.utils.better_eval("recipe_data_value(d)", {"d" : d1}), "1")
+            self.assertIn("recipe_data_handler", bb.event.get_class_handlers())
+            self.assertIsNot(cache.get(g.name, []), None)
+            self.assertNotIn("recipe_data_value", bb.utils.get_context())
+            self.assertNotIn("recipe_data_handler", bb.event.get_class_handlers())
+            self.assertIsNone(cache.get("/nonexistent.bb", []))
+            self.assertNotIn("recipe_data_value", bb.utils.get_context())
+        finally:
+            bb.utils.get_context().clear()
+            bb.utils.get_context().update(context)
+            bb.event.set_class_handlers(handlers)
+
+    def test_parse_classextend_variants(self):
+        cls = self.parsehelper(self.classextend_bbclass, suffix=".bbclass")
+        f = self.parsehelper(self.classextend.replace("###CLASS###", cls.name))
+        # The recipe datastore is a copy of the configuration, as in
+        # Cache.load_bbfile()
+        alldata = bb.parse.handle(f.name, self.d.createCopy())
+        self.assertEqual(alldata[''].getVar("__VARIANTS", False), cls.name)
+        self.assertEqual(alldata[''].getVar("BBCLASSEXTEND", False), cls.name)
+        self.assertEqual(alldata[cls.name].getVar("__VARIANTS", False), cls.name)
+
+    workerbbclass = """
+addhandler worker_context_handler
+worker_context_handler[eventmask] = "bb.event.ConfigParsed"
+python worker_context_handler() {
+    if e.data.getVar("BB_WORKERCONTEXT", True):
+        e.data.setVar("HANDLER_CONTEXT", "worker")
+    else:
+        e.data.setVar("HANDLER_CONTEXT", "cooker")
+}
+"""
+
+    def test_worker_configuration(self):
+        tempdir = tempfile.mkdtemp()
+        context = dict(bb.utils.get_context())
+        handlers = bb.event.get_class_handlers().copy()
+        cwd = os.getcwd()
+        try:
+            os.makedirs(os.path.join(tempdir, "conf"))
+            os.makedirs(os.path.join(tempdir, "classes"))
+            with open(os.path.join(tempdir, "conf", "prefile.conf"), "w") as f:
+                f.write('BBPATH = "%s"\n' % tempdir)
+            with open(os.path.join(tempdir, "conf", "bitbake.conf"), "w") as f:
+                f.write('CACHE = "%s/cache"\n' % tempdir)
+            with open(os.path.join(tempdir, "classes", "base.bbclass"), "w") as f:
+                f.write(self.workerbbclass)
+            os.chdir(tempdir)
+
+            class CookerConfig(object):
+                prefile = [os.path.join(tempdir, "conf", "prefile.conf")]
+                postfile = []
+                tracking = False
+                env = {}
+            builder = bb.cookerdata.CookerDataBuilder(CookerConfig())
+            builder.parseBaseConfiguration()
+            self.assertEqual(builder.data.getVar("HANDLER_CONTEXT", True), "cooker")
+            config = builder.workerConfiguration()
+            self.assertIsNotNone(config)
+
+            # bitbake-worker runs the ConfigParsed handlers itself, in the
+            # worker context
+            worker = bb.cookerdata.CookerDataBuilder(CookerConfig(), worker=True)
+            worker.restoreBaseConfiguration(config)
+            self.assertEqual(worker.data.getVar("HANDLER_CONTEXT", True), "worker")
+            self.assertEqual(worker.data.getVar("BBINCLUDED", False),
+                             builder.data.getVar("BBINCLUDED", False))
+        finally:
+            os.chdir(cwd)
+            bb.utils.get_context().clear()
+            bb.utils.get_context().update(context)
+            bb.event.set_class_handlers(handlers)
+            bb.utils.remove(tempdir, True)
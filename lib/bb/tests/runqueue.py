@@ -0,0 +1,204 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the runqueue schedulers (runqueue.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import collections
+import os
+import random
+import tempfile
+import time
+import bb
+import bb.build
+import bb.runqueue
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def fake_runqueue(fnids, weights, buildable, depends=None, tasknames=None):
+    """
+    Return the (runqueue, rqdata) a scheduler needs for tasks in the given
+    files with the given weights. The tasks have no stamps.
+    """
+    numtasks = len(fnids)
+    buildable = set(buildable)
+    depends = depends or [set() for task in xrange(numtasks)]
+    revdeps = [set() for task in xrange(numtasks)]
+    for task in xrange(numtasks):
+        for dep in depends[task]:
+            revdeps[dep].add(task)
+    dataCache = Namespace(stamp = collections.defaultdict(str),
+                          stamp_base = collections.defaultdict(dict),
+                          stamp_extrainfo = collections.defaultdict(dict))
+    taskData = Namespace(fn_index = ["/recipes/r%s.bb" % fnid for fnid in xrange(max(fnids) + 1)])
+    dataCache.pkg_fn = dict((fn, os.path.basename(fn)[:-3]) for fn in taskData.fn_index)
+    dataCache.task_deps = dict((fn, {}) for fn in taskData.fn_index)
+    rqdata = Namespace(runq_fnid = fnids,
+                       runq_task = tasknames or ["do_task"] * numtasks,
+                       runq_weight = weights,
+                       runq_depends = depends,
+                       runq_revdeps = revdeps,
+                       taskData = taskData,
+                       dataCache = dataCache)
+    rq = Namespace(runq_buildable = [int(task in buildable) for task in xrange(numtasks)],
+                   runq_running = [0] * numtasks,
+                   build_stamps2 = set(),
+                   stats = Namespace(active = 0),
+                   number_tasks = 4,
+                   task_durations = None,
+                   resources = None,
+                   rq = Namespace(scenequeue_covered = set()))
+    return rq, rqdata
+
+class SchedulerTest(unittest.TestCase):
+    fnids = [0, 1, 0, 2, 1, 2, 0]
+    weights = [3, 5, 5, 1, 3, 7, 3]
+
+    def test_basic(self):
+        rq, rqdata = fake_runqueue(self.fnids, self.weights, [1, 3, 5])
+        sched = bb.runqueue.RunQueueScheduler(rq, rqdata)
+        self.assertEqual(sched.prio_map, range(7))
+        self.assertEqual(sched.next(), 1)
+        rq.runq_running[1] = 1
+        sched.newbuilable(0)
+        self.assertEqual(sched.next(), 0)
+
+    def test_speed(self):
+        rq, rqdata = fake_runqueue(self.fnids, self.weights, [1, 3, 5])
+        sched = bb.runqueue.RunQueueSchedulerSpeed(rq, rqdata)
+        # Ties in weight go to the higher task number
+        self.assertEqual(sched.prio_map, [5, 2, 1, 6, 4, 0, 3])
+        self.assertEqual(sched.next(), 5)
+
+    def test_completion(self):
+        rq, rqdata = fake_runqueue(self.fnids, self.weights, [1, 3, 5])
+        sched = bb.runqueue.RunQueueSchedulerCompletion(rq, rqdata)
+        self.assertEqual(sched.prio_map, [5, 3, 2, 6, 0, 1, 4])
+        self.assertEqual(sched.next(), 5)
+        rq.runq_running[5] = 1
+        self.assertEqual(sched.next(), 3)
+
+    def test_criticalpath(self):
+        # r0's compile takes far longer than everything else
+        fnids = [0, 0, 1, 2, 3]
+        tasknames = ["do_compile", "do_install", "do_fetch", "do_fetch", "do_build"]
+        depends = [set(), set([0]), set(), set(), set([2, 3])]
+        rq, rqdata = fake_runqueue(fnids, [2, 1, 3, 3, 1], [0, 2, 3], depends, tasknames)
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            d = bb.data.init()
+            d.setVar("PERSISTENT_DIR", tempdir)
+            durations = bb.runqueue.TaskDurations(d)
+            durations.record("r0", "do_compile", 100.0)
+            durations.record("r0", "do_install", 1.0)
+            durations.record("r1", "do_fetch", 5.0)
+            durations.record("r3", "do_build", 1.0)
+            durations.record("r3", "do_build", 3.0)
+            rq.task_durations = bb.runqueue.TaskDurations(d)
+            self.assertEqual(rq.task_durations.load()["r3:do_build"], 2.0)
+
+            sched = bb.runqueue.RunQueueSchedulerCriticalPath(rq, rqdata)
+            # r2's fetch has no history so it takes as long as r1's
+            self.assertEqual(sched.critical, [101.0, 1.0, 7.0, 7.0, 2.0])
+            self.assertEqual(sched.prio_map, [0, 3, 2, 4, 1])
+            self.assertEqual(sched.next(), 0)
+
+            # The speed scheduler would start with the fetches
+            sched = bb.runqueue.RunQueueSchedulerSpeed(rq, rqdata)
+            self.assertEqual(sched.next(), 3)
+
+            # Covered tasks won't run
+            rq.rq.scenequeue_covered.add(0)
+            sched = bb.runqueue.RunQueueSchedulerCriticalPath(rq, rqdata)
+            self.assertEqual(sched.critical[0], 1.0)
+            self.assertEqual(sched.next(), 3)
+        finally:
+            bb.utils.remove(tempdir, True)
+
+    def test_resources(self):
+        fnids = [0, 1, 2, 3, 4]
+        tasknames = ["do_compile", "do_compile", "do_fetch", "do_fetch", "do_package"]
+        rq, rqdata = fake_runqueue(fnids, [5, 4, 3, 2, 1], range(5), tasknames=tasknames)
+        for fn in rqdata.taskData.fn_index:
+            rqdata.dataCache.task_deps[fn] = {'resources' : {'do_compile' : 'cpu memory=3',
+                                                             'do_fetch' : 'network'}}
+        d = bb.data.init()
+        d.setVar("BB_RESOURCE_LIMITS", "memory=4 network=1")
+        d.setVar("BB_RESOURCE_MAX_LOADAVG", "8")
+        rq.resources = bb.runqueue.RunQueueResources(rqdata, d)
+        # Use fixed readings rather than the ones of this machine
+        rq.resources.readtime = time.time() + 3600
+        rq.resources.loadavg = 1.0
+        self.assertEqual(rq.resources.demand(0), {"cpu" : 1.0, "memory" : 3.0})
+
+        sched = bb.runqueue.RunQueueSchedulerSpeed(rq, rqdata)
+        def start(task):
+            self.assertEqual(sched.next(), task)
+            rq.runq_running[task] = 1
+            rq.resources.start(task)
+
+        # The second compile would exceed the memory budget, only one
+        # fetch may use the network at a time
+        start(0)
+        start(2)
+        start(4)
+        self.assertEqual(sched.next(), None)
+        rq.resources.finish(2)
+        start(3)
+        rq.resources.finish(0)
+        rq.resources.loadavg = 10.0
+        self.assertEqual(sched.next(), None)
+        rq.resources.loadavg = 1.0
+        start(1)
+
+        # A task is admitted when nothing else runs, whatever it needs
+        for task in (1, 3, 4):
+            rq.resources.finish(task)
+        rq.resources.loadavg = 10.0
+        self.assertTrue(rq.resources.admit(0))
+
+class SchedulerBenchmark(unittest.TestCase):
+    """
+    Construction time of the schedulers for large synthetic runqueues,
+    which should grow close to linearly with the number of tasks
+    """
+
+    if os.environ.get("BB_RUN_BENCHMARKS") != "yes":
+        print("Set BB_RUN_BENCHMARKS=yes to run benchmarks")
+    else:
+        def testConstruction(self):
+            def measure(cls, numtasks):
+                rnd = random.Random(numtasks)
+                fnids = [rnd.randrange(numtasks // 10) for task in xrange(numtasks)]
+                weights = [rnd.randrange(1000) for task in xrange(numtasks)]
+                rq, rqdata = fake_runqueue(fnids, weights, range(0, numtasks, 7))
+                start = time.time()
+                sched = cls(rq, rqdata)
+                sched.next()
+                return time.time() - start
+
+            for cls in (bb.runqueue.RunQueueScheduler,
+                        bb.runqueue.RunQueueSchedulerSpeed,
+                        bb.runqueue.RunQueueSchedulerCompletion,
+                        bb.runqueue.RunQueueSchedulerCriticalPath):
+                small = measure(cls, 10000)
+                large = measure(cls, 100000)
+                print("\n%s: 10000 tasks %.4fs, 100000 tasks %.4fs" % (cls.name, small, large))
+                self.assertLess(large, small * 30)
@@ -21,8 +21,10 @@
 
 import unittest
 import bb
+import bb.framing
 import os
 import tempfile
+import pickle
 
 class VerCmpString(unittest.TestCase):
 
@@ -108,6 +110,46 @@ class Path(unittest.TestCase):
             self.assertEqual(result, correctresult, '_check_unsafe_delete_path("%s") != %s' % (arg1, correctresult))
 
 
+class Compile(unittest.TestCase):
+    def test_better_compile_cache(self):
+        import bb.methodpool
+        text = "x = y * 2\n"
+        code = bb.utils.better_compile(text, "test_compile", "test_compile")
+        self.assertIs(bb.utils.better_compile(text, "test_compile", "test_compile"), code)
+        self.assertIsNot(bb.utils.better_compile(text, "other_compile", "other_compile"), code)
+
+        # A marshalled entry from another process gives an equivalent code object
+        cache = bb.methodpool.CodeCache()
+        cache.code.update(bb.methodpool.codecache.codeextras)
+        code = cache.get(text, "test_compile", "exec")
+        context = {"y": 21}
+        exec(code, context)
+        self.assertEqual(context["x"], 42)
+        self.assertEqual(code.co_filename, "test_compile")
+
+
+class Framing(unittest.TestCase):
+    def test_frames(self):
+        data = "".join(bb.framing.frame("event", pickle.dumps(i)) for i in range(1000))
+        data += bb.framing.frame("quit")
+
+        # Messages split across reads are only returned once complete
+        queue = bb.framing.FrameBuffer()
+        messages = []
+        for i in range(0, len(data), 7):
+            queue.feed(data[i:i + 7])
+            for name, payload in queue.frames():
+                if name == "event":
+                    messages.append(bb.framing.load(payload))
+                else:
+                    messages.append(name)
+        self.assertEqual(messages, range(1000) + ["quit"])
+        self.assertEqual(len(queue), 0)
+
+        queue.feed(data[:10])
+        self.assertEqual(list(queue.frames()), [])
+        self.assertEqual(str(queue), data[:10])
+
 class EditMetadataFile(unittest.TestCase):
     _origfile = """
 # A comment
@@ -296,8 +296,14 @@ def better_compile(text, file, realfile, mode = "exec"):
     A better compile method. This method
     will print the offending lines.
     """
+    import bb.methodpool
+    code = bb.methodpool.codecache.get(text, file, mode)
+    if code is not None:
+        return code
     try:
-        return compile(text, file, mode)
+        code = compile(text, file, mode)
+        bb.methodpool.codecache.add(text, file, mode, code)
+        return code
     except Exception as e:
         error = []
         # split the text into lines again